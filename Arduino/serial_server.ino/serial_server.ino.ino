@@ -1,6 +1,11 @@
 /*
   Serial Server
-     - Respond to single character commands received via serial
+     - Respond to single character commands received via serial ("w0;"), echoed back on two lines
+     - Respond to binary packets with a signed PWM value per wheel (see serial_client.py):
+         0xA5, sequence number, left PWM (int16), right PWM (int16), flags, checksum
+       Packets with the ack flag are answered with 0xA6, sequence number, checksum.
+       The motors stop if no packet arrived for WATCHDOG_MS.
+     - Bytes are parsed as they arrive, the loop never blocks
 */
 
 #include "pitches.h"
@@ -16,6 +21,22 @@
 #define EYE_LEFT 1
 #define SPEAKER 11
 
+// Binary protocol
+#define PACKET_START 0xA5
+#define ACK_START 0xA6
+#define PACKET_SIZE 8
+#define FLAG_ACK 0x01
+#define WATCHDOG_MS 500
+
+// Bytes of the packet or text command that is currently received
+byte packet[PACKET_SIZE];
+byte packet_len = 0;
+char text[16];
+byte text_len = 0;
+
+// Time of the last valid packet, the watchdog only runs while the robot is driven by packets
+unsigned long last_packet = 0;
+bool packet_driving = false;
 
 
 void setup() {
@@ -38,16 +59,92 @@ void setup() {
 }
 
 void loop() {
-  
-  // Check for any incoming bytes
-  if (Serial.available() > 0) {
-    char wheel = Serial.read();
-    String voltage = Serial.readStringUntil(';');
 
-    int volt = voltage.toInt();
+  // Handle all bytes that arrived, without waiting for the rest of a command
+  while (Serial.available() > 0) {
+    byte b = Serial.read();
+
+    if (packet_len > 0) {
+      packet[packet_len++] = b;
+      if (packet_len == PACKET_SIZE) {
+        handle_packet();
+      }
+    }
+    else if (b == PACKET_START) {
+      // A packet start always wins: a half received text command (e.g. after a desync) is thrown away
+      packet[0] = b;
+      packet_len = 1;
+      text_len = 0;
+    }
+    else if (b == ';') {
+      text[text_len] = '\0';
+      if (text_len > 0) {
+        handle_text(text[0], atoi(text + 1));
+      }
+      text_len = 0;
+    }
+    else if (b >= 0x20 && b <= 0x7E && text_len < sizeof(text) - 1) {
+      // Only printable characters can be part of a text command, stray bytes of binary packets are ignored
+      text[text_len++] = b;
+    }
+  }
+
+  // Stop if the controlling program stopped sending packets
+  if (packet_driving && millis() - last_packet > WATCHDOG_MS) {
+    set_wheels(0, 0);
+    packet_driving = false;
+  }
+}
+
+
+byte checksum(byte *data, byte len) {
+  byte value = 0xFF;
+  for (byte i = 0; i < len; i++) {
+    value ^= data[i];
+  }
+  return value;
+}
+
+
+void handle_packet() {
+  // Packets with a wrong checksum are dropped, the sender notices the missing ack. The start byte may have been a
+  // stray byte, so the received bytes are searched for the start of the real packet.
+  if (checksum(packet + 1, PACKET_SIZE - 2) != packet[PACKET_SIZE - 1]) {
+    resync_packet();
+    return;
+  }
+  packet_len = 0;
+  int left = (int16_t) (packet[2] | (packet[3] << 8));
+  int right = (int16_t) (packet[4] | (packet[5] << 8));
+  set_wheels(left, right);
+  last_packet = millis();
+  packet_driving = true;
+
+  if (packet[6] & FLAG_ACK) {
+    byte ack[3] = {ACK_START, packet[1], checksum(packet + 1, 1)};
+    Serial.write(ack, 3);
+  }
+}
+
+
+// Keeps the received bytes from the next start byte on as the beginning of a new packet, or drops them all
+void resync_packet() {
+  byte start = 1;
+  while (start < PACKET_SIZE && packet[start] != PACKET_START) {
+    start++;
+  }
+  packet_len = PACKET_SIZE - start;
+  for (byte i = 0; i < packet_len; i++) {
+    packet[i] = packet[start + i];
+  }
+}
+
+
+void handle_text(char wheel, int volt) {
 
     Serial.println(wheel);
     Serial.println(volt);
+    packet_driving = false;
 
     // Respond to command "w" -> forward
     if(wheel == 'w') {
@@ -98,12 +195,24 @@ void loop() {
       analogWrite(MOTOR_RIGHT, 0);
       analogWrite(MOTOR_LEFT, 0);
       play_shutdown();
-    }                                                                                                                                                                                                                                                                      
-    
-  }
+    }
+}
+
 
-  // Wait a bit
-  delay(10);
+// Sets direction and speed of both wheels, negative PWM -> backwards
+void set_wheels(int left, int right) {
+  if (left >= 0) {
+    forward_left();
+  } else {
+    backward_left();
+  }
+  if (right >= 0) {
+    forward_right();
+  } else {
+    backward_right();
+  }
+  analogWrite(MOTOR_LEFT, min(abs(left), 255));
+  analogWrite(MOTOR_RIGHT, min(abs(right), 255));
 }
 
 
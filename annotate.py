@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline face and pose annotation of image collections and videos.
+
+Runs the same Haar cascade face detection, face recognition and MoveNet pose detection as cameraStream.py over all
+frames of an image directory, a glob pattern, a recorded MJPEG stream or a video file. Loading, decoding and face
+detection of the frames run in a pool of worker processes; the main process owns the Edge TPU and is fed by the pool
+in frame order, while the pool already works on the next frames and draws and saves the annotated images of the
+previous ones. All detections are appended to one annotations.jsonl file in the output directory (one JSON line per
+frame). Frames that are already in that file are skipped, so an interrupted run continues where it stopped.
+
+    python annotate.py ../session/ ../session_annotated --faces --poses
+    python annotate.py 'recordings/*.jpg' out/ --faces --recognise --workers 3
+    python annotate.py stream.mjpg out/ --poses --stand-ins
+"""
+
+import argparse
+import glob
+import json
+import logging
+import multiprocessing as mp
+import os
+import sys
+import time
+from collections import deque
+from functools import partial
+
+import cv2
+
+import vision
+import overlay
+import stand_ins
+from models import load_interpreter
+
+CASCADE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'haarcascade_frontalface_default.xml')
+FACE_MODEL = 'coral/face.tflite'
+POSE_MODEL = 'coral/movenet_single_pose_thunder_ptq_edgetpu.tflite'
+
+ANNOTATIONS_FILE = 'annotations.jsonl'
+VIDEO_PATTERN = 'frame_%06i.jpg'  # Names of the annotated frames of MJPEG and video files
+MJPEG_EXTENSIONS = ('.mjpg', '.mjpeg')
+
+# Workers are forked, so they get the settings and the face detector without pickling
+_CTX = mp.get_context('fork')
+_det = None  # Haar cascade of each pool worker
+
+
+###############
+## FRAME SOURCES
+###############
+
+def _image_files(source):
+    """Sorted paths of the images of a directory or glob pattern."""
+    if os.path.isdir(source):
+        fnames = [os.path.join(source, f) for f in os.listdir(source)]
+    else:
+        fnames = glob.glob(source)
+    return sorted(f for f in fnames if f.lower().endswith(stand_ins.IMAGE_EXTENSIONS))
+
+
+def source_root(source):
+    """Directory that contains all frames of the source. The frames of an image collection are named by their path
+    relative to it."""
+    if os.path.isdir(source):
+        return source
+    fnames = [] if os.path.isfile(source) else _image_files(source)
+    if fnames:
+        return os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in fnames])
+    return os.path.dirname(source) or '.'
+
+
+def iter_frames(source, skip=()):
+    """Returns a generator of (name, frame) and the number of frames. frame is the path of an image file, the JPEG
+    bytes of an MJPEG frame or the decoded frame of a video, so images are only loaded in the workers. Frames whose
+    name is in skip are left out (video frames are skipped without decoding them)."""
+    if os.path.isdir(source) or not os.path.isfile(source):
+        # Images of different directories can have the same file name, so they are named by their relative path
+        root = source_root(source)
+        items = [(os.path.relpath(os.path.abspath(f), os.path.abspath(root)), f) for f in _image_files(source)]
+        return (item for item in items if item[0] not in skip), len(items)
+
+    if source.lower().endswith(stand_ins.IMAGE_EXTENSIONS):
+        return iter([(os.path.basename(source), source)]), 1
+
+    if source.lower().endswith(MJPEG_EXTENSIONS):
+        def mjpeg_frames():
+            for i, jpeg in enumerate(stand_ins.read_mjpeg(source)):
+                if VIDEO_PATTERN % i not in skip:
+                    yield VIDEO_PATTERN % i, bytes(jpeg)
+        return mjpeg_frames(), None
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError('Could not open %s' % source)
+
+    def video_frames():
+        try:
+            i = 0
+            while True:
+                if VIDEO_PATTERN % i in skip:
+                    # Frames that are already annotated are not decoded
+                    if not capture.grab():
+                        break
+                else:
+                    ok, frame = capture.read()
+                    if not ok:
+                        break
+                    yield VIDEO_PATTERN % i, frame
+                i += 1
+        finally:
+            capture.release()
+    return video_frames(), int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+
+
+def read_done(fname):
+    """Names of the frames that are already in an annotations file."""
+    done = set()
+    if os.path.exists(fname):
+        with open(fname) as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['frame'])
+                except (ValueError, KeyError):
+                    pass  # Line of an interrupted write, the frame is annotated again
+    return done
+
+
+###############
+## WORKER STAGES
+###############
+
+def _init_worker(cascade_file):
+    global _det
+    _det = cv2.CascadeClassifier(cascade_file)
+
+
+def _load_and_detect(item, detect_faces, min_face_size):
+    """Loads or decodes a frame and finds the faces in it, in a pool worker."""
+    name, data = item
+    if isinstance(data, str):
+        frame = cv2.imread(data)
+    elif isinstance(data, bytes):
+        frame = vision.decode_frame(data)
+    else:
+        frame = data
+    if frame is None or not detect_faces:
+        return name, frame, []
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return name, frame, vision.detect_faces(_det, gray, min_size=(min_face_size, min_face_size))
+
+
+def _draw_and_write(fname, frame, rects, colors, pose, quality):
+    """Draws the detections onto the frame and saves it, in a pool worker."""
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    overlay.draw_faces(frame, rects, colors, None)
+    if pose is not None:
+        overlay.draw_pose(frame, pose)
+    cv2.imwrite(fname, frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+
+
+class Progress(object):
+    """Prints the number of annotated frames, the frame rate and the remaining time every few seconds."""
+
+    def __init__(self, total, done=0, interval=2.0):
+        self.total = total
+        self.done = done
+        self.count = 0
+        self.interval = interval
+        self.start = self.last = time.monotonic()
+
+    def update(self):
+        self.count += 1
+        if time.monotonic() - self.last >= self.interval:
+            self.report()
+
+    def report(self):
+        now = self.last = time.monotonic()
+        fps = self.count / max(now - self.start, 1e-6)
+        msg = '%i frames annotated, %.1f fps' % (self.done + self.count, fps)
+        if self.total is not None:
+            remaining = max(self.total - self.done - self.count, 0)
+            msg = '%i/%i frames annotated, %.1f fps, %i s left' % (self.done + self.count, self.total, fps,
+                                                                   remaining / fps if fps else 0)
+        print(msg, file=sys.stderr)
+
+
+def annotate(args):
+    os.makedirs(args.output, exist_ok=True)
+    annotations_file = os.path.join(args.output, ANNOTATIONS_FILE)
+    done = read_done(annotations_file)
+    items, total = iter_frames(args.source, done)
+    items = iter(items)
+    progress = Progress(total, len(done))
+
+    detect = partial(_load_and_detect, detect_faces=args.faces, min_face_size=args.min_face_size)
+    detections = deque()  # Results of the frames that are loaded and detected in the pool, in frame order
+    writes = deque()  # (record, result) of the frames whose annotated images are saved in the pool
+
+    with _CTX.Pool(args.workers, _init_worker, (CASCADE_FILE,)) as pool, open(annotations_file, 'a') as out:
+        # The Edge TPU is only used from the main process, the models are loaded after the workers were forked
+        face_interpreter = pose_interpreter = None
+        if args.stand_ins:
+            vision.use_helpers(stand_ins)
+        if args.faces and args.recognise:
+            face_interpreter = stand_ins.face_interpreter() if args.stand_ins else load_interpreter(args.face_model)
+        if args.poses:
+            pose_interpreter = stand_ins.pose_interpreter() if args.stand_ins else load_interpreter(args.pose_model)
+
+        def submit():
+            # Only a limited number of frames is in flight, so a long video is not read into memory at once
+            item = next(items, None)
+            if item is not None:
+                detections.append(pool.apply_async(detect, (item,)))
+
+        def finish(record, result):
+            # The record is only written when the image is saved, so a resumed run never misses an image
+            if result is not None:
+                result.get()
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            progress.update()
+
+        for _ in range(args.queue):
+            submit()
+        while detections:
+            # While the TPU works on this frame, the workers already load and detect the next ones
+            name, frame, rects = detections.popleft().get()
+            submit()
+            if frame is None:
+                logging.warning('Could not read frame %s', name)
+                continue
+
+            if face_interpreter is not None:
+                colors = vision.recognise_faces(face_interpreter, frame, rects)
+            else:
+                colors = [(0, 255, 0)] * len(rects)
+            pose = None
+            if pose_interpreter is not None:
+                # MoveNet expects RGB, like in coral/coralPose.py
+                pose = vision.detect_pose(pose_interpreter, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+            record = {'frame': name, 'height': frame.shape[0], 'width': frame.shape[1], 'faces': rects}
+            if face_interpreter is not None:
+                record['recognised'] = [color == vision.face_color(True) for color in colors]
+            if pose is not None:
+                record['pose'] = pose.astype(float).round(4).tolist()
+
+            result = None
+            if not args.no_images:
+                result = pool.apply_async(_draw_and_write, (os.path.join(args.output, name), frame, rects, colors,
+                                                            pose, args.quality))
+            writes.append((record, result))
+            # Write out the finished frames in order, and wait for the oldest one if too many images are pending
+            while writes and (writes[0][1] is None or writes[0][1].ready() or len(writes) > args.queue):
+                finish(*writes.popleft())
+
+        while writes:
+            finish(*writes.popleft())
+    progress.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('source', help='Image directory, glob pattern of images, MJPEG file or video file')
+    parser.add_argument('output', help='Directory of the annotated images and of %s' % ANNOTATIONS_FILE)
+    parser.add_argument('--faces', action='store_true', help='Detect faces with the Haar cascade')
+    parser.add_argument('--recognise', action='store_true', help='Recognise the detected faces on the Edge TPU')
+    parser.add_argument('--poses', action='store_true', help='Detect the pose with MoveNet on the Edge TPU')
+    parser.add_argument('--min-face-size', type=int, default=152, help='Minimum face size [px]')
+    parser.add_argument('--face-model', default=FACE_MODEL)
+    parser.add_argument('--pose-model', default=POSE_MODEL)
+    parser.add_argument('--stand-ins', action='store_true', help='Use CPU stand-ins instead of the Edge TPU models')
+    parser.add_argument('--workers', type=int, default=max(1, os.cpu_count() - 1), help='Number of worker processes')
+    parser.add_argument('--queue', type=int, default=16, help='Maximum number of frames in flight per stage')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the annotated images')
+    parser.add_argument('--no-images', action='store_true', help='Only write %s' % ANNOTATIONS_FILE)
+    args = parser.parse_args()
+    if not (args.faces or args.poses):
+        parser.error('Nothing to do, use --faces and/or --poses')
+    # The annotated images would overwrite the source images or be annotated again by a later run
+    output, root = os.path.realpath(args.output), os.path.realpath(source_root(args.source))
+    if os.path.commonpath([output, root]) == output:
+        parser.error('The output directory must not be the source directory or contain it')
+    annotate(args)
+
+
+if __name__ == '__main__':
+    main()
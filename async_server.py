@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Asyncio version of the streaming server in cameraStream.py.
+
+All clients are served from one event loop instead of one thread per viewer. Every client always gets the newest
+annotated frame: while a slow client is still busy with the last frame, new frames are not queued for it but simply
+replace each other, so the memory per client stays bounded by the socket write buffer plus one frame.
+
+With an H264Output, the server also streams the camera's hardware encoded H.264 to websocket clients on
+/stream.h264, together with the detections of every frame as JSON, and serves the viewer page on /h264.html (see
+h264_stream.py). H.264 frames depend on the ones before them, so they can't simply be skipped like JPEG frames: a
+client whose socket buffer is full gets nothing until the next key frame.
+"""
+
+import asyncio
+import json
+import logging
+
+import h264_stream
+
+
+class AsyncStreamingServer(object):
+    """Serves the same routes as StreamingHandler (/, /index.html, /stream.mjpg, /metrics, /stages) from an event
+    loop, and optionally the H.264 stream (/h264.html, /stream.h264)."""
+
+    def __init__(self, output, page, address=('', 8000), write_buffer=64 * 1024, metrics=None, scheduler=None,
+                 h264=None, h264_page=None, h264_buffer=512 * 1024):
+        self.output = output  # AnnotatedOutput with the processed frames
+        self.metrics = metrics  # Optional Metrics that are served on /metrics and /metrics.json
+        self.scheduler = scheduler  # Optional StageScheduler that is controlled through /stages
+        self.page = page.encode('utf-8')
+        self.address = address
+        self.write_buffer = write_buffer  # Bytes that may wait in the socket buffer before a client is "slow"
+        self.clients = 0  # Number of connected streaming clients
+        self.h264 = h264  # Optional h264_stream.H264Output with the camera's H.264 stream
+        self.h264_page = h264_page.encode('utf-8') if h264_page is not None else None
+        self.h264_buffer = h264_buffer  # Bytes that may wait in the socket buffer of an H.264 client
+        self.h264_clients = {}  # Transport of every websocket client -> True while it waits for a key frame
+
+        self.loop = None
+        self._new_frame = None  # Future that is resolved when the next frame is published
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._new_frame = self.loop.create_future()
+        self.output.add_listener(self._on_publish)
+        if self.h264 is not None:
+            self.h264.add_listener(self._on_h264)
+            self.output.add_overlay_listener(self._on_overlay)
+
+        host, port = self.address
+        server = await asyncio.start_server(self._handle, host or None, port, reuse_address=True)
+        async with server:
+            await server.serve_forever()
+
+    def _on_publish(self):
+        # Called from the processing thread, so hand the notification over to the event loop
+        self.loop.call_soon_threadsafe(self._wake_clients)
+
+    def _wake_clients(self):
+        if not self._new_frame.done():
+            self._new_frame.set_result(None)
+        self._new_frame = self.loop.create_future()
+
+    def _on_h264(self, data, key_frame):
+        # Called from the camera's encoder thread
+        if self.h264_clients:
+            self.loop.call_soon_threadsafe(self._send_h264, data, key_frame)
+
+    def _send_h264(self, data, key_frame):
+        message = h264_stream.websocket_frame(data)
+        for transport, waiting in self.h264_clients.items():
+            if transport.is_closing() or (waiting and not key_frame):
+                continue
+            if transport.get_write_buffer_size() > self.h264_buffer:
+                # The client can't keep up: skip frames until the next key frame, from which it can decode again
+                self.h264_clients[transport] = True
+                if self.metrics is not None:
+                    self.metrics.count('h264_dropped')
+                continue
+            self.h264_clients[transport] = False
+            transport.write(message)
+
+    def _on_overlay(self, data):
+        # Called from the processing thread with the detections of a frame
+        if self.h264_clients:
+            self.loop.call_soon_threadsafe(self._send_overlay, data)
+
+    def _send_overlay(self, data):
+        message = h264_stream.websocket_frame(data.encode('utf-8'), h264_stream.OPCODE_TEXT)
+        for transport, waiting in self.h264_clients.items():
+            if not waiting and not transport.is_closing() and transport.get_write_buffer_size() <= self.h264_buffer:
+                transport.write(message)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            parts = request.decode('latin-1').split()
+            method = parts[0] if parts else ''
+            path, _, query = parts[1].partition('?') if len(parts) > 1 else ('', '', '')
+            if method == 'POST' and path == '/stages' and self.scheduler is not None:
+                await self._configure(writer, query)
+            elif method != 'GET' or not path:
+                await self._send(writer, 405, 'Method Not Allowed')
+            elif path == '/':
+                await self._send(writer, 301, 'Moved Permanently', [('Location', '/index.html')])
+            elif path == '/index.html':
+                await self._send(writer, 200, 'OK', [('Content-Type', 'text/html')], self.page)
+            elif path == '/metrics' and self.metrics is not None:
+                await self._send(writer, 200, 'OK', [('Content-Type', 'text/plain; version=0.0.4')],
+                                 self.metrics.to_prometheus().encode('utf-8'))
+            elif path == '/metrics.json' and self.metrics is not None:
+                await self._send(writer, 200, 'OK', [('Content-Type', 'application/json')],
+                                 self.metrics.to_json().encode('utf-8'))
+            elif path == '/stages' and self.scheduler is not None:
+                await self._send(writer, 200, 'OK', [('Content-Type', 'application/json')],
+                                 json.dumps(self.scheduler.state()).encode('utf-8'))
+            elif path == '/stream.mjpg':
+                await self._stream(writer)
+            elif path == '/h264.html' and self.h264_page is not None:
+                await self._send(writer, 200, 'OK', [('Content-Type', 'text/html')], self.h264_page)
+            elif path == '/stream.h264' and self.h264 is not None and 'sec-websocket-key' in headers:
+                await self._stream_h264(reader, writer, headers['sec-websocket-key'])
+            else:
+                await self._send(writer, 404, 'Not Found')
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.warning('Removed streaming client %s: %s', writer.get_extra_info('peername'), str(e))
+        finally:
+            writer.close()
+
+    async def _configure(self, writer, query):
+        # Switch processing stages or the target frame rate, e.g. POST /stages?detect_poses=1&target_fps=12
+        try:
+            self.scheduler.configure(query)
+        except ValueError as e:
+            await self._send(writer, 400, 'Bad Request', [('Content-Type', 'text/plain')], str(e).encode('utf-8'))
+            return
+        await self._send(writer, 200, 'OK', [('Content-Type', 'application/json')],
+                         json.dumps(self.scheduler.state()).encode('utf-8'))
+
+    @staticmethod
+    async def _send(writer, status, reason, headers=(), body=b''):
+        lines = ['HTTP/1.0 %i %s' % (status, reason)] + ['%s: %s' % header for header in headers]
+        lines.append('Content-Length: %i' % len(body))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+
+    async def _stream(self, writer):
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Age: 0\r\n'
+                     b'Cache-Control: no-cache, private\r\n'
+                     b'Pragma: no-cache\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n\r\n')
+        # drain() only blocks once this much data is waiting for the client
+        writer.transport.set_write_buffer_limits(high=self.write_buffer)
+
+        self.clients += 1
+        self.output.add_viewer()
+        if self.metrics is not None:
+            self.metrics.set_gauge('clients', self.clients)
+        try:
+            seq = 0
+            while True:
+                # Wait for a frame newer than the one that was sent last. Frames that were published while the client
+                # was still busy are skipped, the client directly gets the newest one.
+                if self.output.seq <= seq:
+                    await asyncio.shield(self._new_frame)
+                seq, frame = self.output.latest()
+
+                writer.write(b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: %i\r\n\r\n' % len(frame))
+                writer.write(memoryview(frame))
+                writer.write(b'\r\n')
+                await writer.drain()
+        finally:
+            self.clients -= 1
+            self.output.add_viewer(-1)
+            if self.metrics is not None:
+                self.metrics.set_gauge('clients', self.clients)
+
+    async def _stream_h264(self, reader, writer, key):
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\n'
+                      'Upgrade: websocket\r\n'
+                      'Connection: Upgrade\r\n'
+                      'Sec-WebSocket-Accept: %s\r\n\r\n' % h264_stream.websocket_accept(key)).encode('latin-1'))
+        await writer.drain()
+
+        # The stream is written by _send_h264 and _send_overlay, the new client starts with the next key frame
+        self.h264_clients[writer.transport] = True
+        if self.h264.request_key_frame is not None:
+            self.h264.request_key_frame()
+        if self.metrics is not None:
+            self.metrics.set_gauge('h264_clients', len(self.h264_clients))
+        try:
+            # Messages from the browser are not needed, only wait until it closes the connection
+            while True:
+                opcode, _ = await h264_stream.read_websocket_frame(reader)
+                if opcode == h264_stream.OPCODE_CLOSE:
+                    writer.write(h264_stream.websocket_frame(b'', h264_stream.OPCODE_CLOSE))
+                    break
+        finally:
+            del self.h264_clients[writer.transport]
+            if self.metrics is not None:
+                self.metrics.set_gauge('h264_clients', len(self.h264_clients))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the camera stream processing, without a Raspberry Pi camera or a Coral.
+
+Replays a recorded MJPEG file (e.g. a saved /stream.mjpg) or a directory of images through the same FrameProcessor
+that cameraStream.py uses, with the Edge TPU models replaced by CPU stand-ins with a fixed latency (see stand_ins.py).
+Every combination of DETECT_FACES, RECOGNISE_FACES and DETECT_POSES is measured and the throughput and the latency
+percentiles of every processing stage are reported, so performance regressions show up on a normal Linux computer.
+
+The other camera scripts can be measured the same way: --script follow_line replays small YUV frames through
+find_line and the LineController of follow_line.py (without sending the commands), --script coralPose runs the
+MoveNet stand-in and the pose drawing of coral/coralPose.py on every frame.
+
+    python benchmark.py recording.mjpg
+    python benchmark.py coral/ --frames 100 --capture-mode mjpeg
+    python benchmark.py recording.mjpg --realtime 10 --json results.json
+    python benchmark.py recording.mjpg --script follow_line --realtime 10
+"""
+
+import argparse
+import itertools
+import json
+import os
+import time
+
+import cv2
+
+import stand_ins
+import vision
+import overlay
+import follow_line
+from capture import YUVOutput
+from frame_buffer import FrameBuffer
+from latency import LatencyTracer
+from metrics import Metrics
+from processor import AnnotatedOutput, FrameProcessor
+from inference import InferenceService
+from scheduler import StageScheduler
+
+CASCADE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'haarcascade_frontalface_default.xml')
+
+# Minimum size [px] of a detected face in a 640x480 frame, as in cameraStream.py
+MIN_FACE_SIZE = 152
+
+# Stages that are reported, in the order of the processing
+STAGES = ('decode_analysis', 'decode', 'pose', 'detect', 'recognise', 'draw', 'encode', 'total', 'tpu_queue',
+          'queue_delay', 'glass_to_glass')
+
+
+def stage_combinations():
+    """All combinations of the processing flags of cameraStream.py. Recognition only runs on detected faces."""
+    for detect_faces, recognise_faces, detect_poses in itertools.product((False, True), repeat=3):
+        if recognise_faces and not detect_faces:
+            continue
+        yield {'detect_faces': detect_faces, 'save_faces': False,
+               'recognise_faces': recognise_faces, 'detect_poses': detect_poses}
+
+
+def make_processor(stages, args, metrics):
+    """Builds the outputs and a FrameProcessor like cameraStream.py does, with stand-ins for the Edge TPU."""
+    if args.capture_mode == 'yuv':
+        source = YUVOutput(args.resolution)
+    else:
+        source = FrameBuffer()
+    analysis = None
+    analysis_resolution = args.resolution
+    if args.analysis_resolution is not None:
+        analysis = YUVOutput(args.analysis_resolution)
+        analysis_resolution = args.analysis_resolution
+    min_face_size = int(MIN_FACE_SIZE * analysis_resolution[0] / 640)
+
+    scheduler = StageScheduler(stages, args.target_fps, min_intervals={'detect_poses': args.pose_interval},
+                               metrics=metrics)
+    inference = InferenceService({'face': stand_ins.face_interpreter(args.face_latency),
+                                  'pose': stand_ins.pose_interpreter(args.pose_latency)}, metrics=metrics)
+    if args.inference_service:
+        inference.start()
+    processor = FrameProcessor(source, AnnotatedOutput(), stages, cv2.CascadeClassifier(CASCADE_FILE),
+                               capture_mode=args.capture_mode, analysis=analysis, min_face_size=min_face_size,
+                               detect_interval=args.detect_interval, scheduler=scheduler, metrics=metrics,
+                               tracer=LatencyTracer(metrics, args.trace), inference=inference)
+    return processor
+
+
+def run_offline(frames, stages, args):
+    """Processes every frame once, as fast as possible, and returns the metrics and the achieved frame rate."""
+    metrics = Metrics(window=len(frames))
+    processor = make_processor(stages, args, metrics)
+    source, analysis = processor.source, processor.analysis
+
+    # Encode in advance like the camera would deliver the frames, so only the processing is measured
+    encoded = stand_ins.encode_frames(frames, args.capture_mode, args.resolution)
+    if analysis is not None:
+        encoded_analysis = stand_ins.encode_frames(frames, 'yuv', args.analysis_resolution)
+
+    start = time.perf_counter()
+    try:
+        for i, raw in enumerate(encoded):
+            if analysis is not None:
+                analysis.write(encoded_analysis[i])
+            source.write(raw)
+            if args.capture_mode == 'yuv':
+                seq, raw = source.seq, source.frame
+            else:
+                source.flush()
+                seq, raw = source.read()
+            processor.handle(seq, raw)
+        elapsed = time.perf_counter() - start
+    finally:
+        processor.stop()
+        processor.tracer.close()
+    return metrics, len(frames) / elapsed
+
+
+def run_realtime(frames, stages, args):
+    """Replays the frames at the camera frame rate into the background FrameProcessor, like on the robot. Frames
+    that arrive while the previous one is still processed are dropped."""
+    metrics = Metrics()
+    processor = make_processor(stages, args, metrics)
+    processor.start()
+
+    # The processor, its inference thread and the trace file are closed, so they don't slow down the next run
+    try:
+        camera = stand_ins.FakeCamera(frames, args.resolution, args.framerate)
+        with camera:
+            camera.start_recording(processor.source, format=args.capture_mode)
+            if processor.analysis is not None:
+                camera.start_recording(processor.analysis, format='yuv', splitter_port=2,
+                                       resize=args.analysis_resolution)
+            time.sleep(args.realtime)
+    finally:
+        processor.stop()
+        processor.tracer.close()
+    return metrics, metrics.snapshot()['fps']
+
+
+def run_follow_line(frames, args):
+    """Replays small YUV frames through the line detection and the controller of follow_line.py, every frame once or
+    at the camera frame rate (--realtime). Returns the metrics and the achieved frame rate."""
+    resolution = follow_line.ANALYSIS_RESOLUTION
+    chroma = follow_line.target_chroma(follow_line.COLOR)
+    rows = follow_line.band_rows(resolution[1] // 2)
+    controller = follow_line.LineController()
+    output = YUVOutput(resolution)
+
+    def control(metrics):
+        start = time.perf_counter()
+        raw = output.acquire()
+        try:
+            u, v = output.chroma(raw)
+            with metrics.time('find_line'):
+                offset, heading = follow_line.find_line(u, v, rows, chroma)
+        finally:
+            output.release()
+        controller.update(offset, heading, time.monotonic())
+        metrics.observe('control', time.perf_counter() - start)
+        metrics.frame_published()
+
+    if args.realtime is None:
+        metrics = Metrics(window=len(frames))
+        encoded = stand_ins.encode_frames(frames, 'yuv', resolution)
+        start = time.perf_counter()
+        for raw in encoded:
+            output.write(raw)
+            control(metrics)
+        return metrics, len(frames) / (time.perf_counter() - start)
+
+    metrics = Metrics()
+    with stand_ins.FakeCamera(frames, args.resolution, args.framerate) as camera:
+        camera.start_recording(output, format='yuv', resize=resolution)
+        seq = 0
+        end = time.monotonic() + args.realtime
+        while time.monotonic() < end:
+            # Like follow_line.py: wait for the newest frame, the ones in between are skipped
+            new_seq, _, missed = output.wait(seq, timeout=0.5)
+            if new_seq == seq:
+                continue
+            seq = new_seq
+            metrics.count('dropped_frames', missed)
+            control(metrics)
+    return metrics, metrics.snapshot()['fps']
+
+
+def run_coral_pose(frames, args):
+    """Runs the MoveNet stand-in and draws the pose on every frame, like coral/coralPose.py does for one image."""
+    metrics = Metrics(window=len(frames))
+    interpreter = stand_ins.pose_interpreter(args.pose_latency)
+    start = time.perf_counter()
+    for frame in frames:
+        frame = frame.copy()
+        with metrics.time('pose'):
+            pose = vision.detect_pose(interpreter, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        with metrics.time('draw'):
+            overlay.draw_pose(frame, pose)
+        metrics.count('pose_invokes')
+        metrics.frame_published()
+    return metrics, len(frames) / (time.perf_counter() - start)
+
+
+def report(stages, snapshot, fps):
+    enabled = [name for name in ('detect_faces', 'recognise_faces', 'detect_poses') if stages[name]] or ['none']
+    print('%s: %.1f fps, %i dropped frames, %i face / %i pose invokes'
+          % (', '.join(enabled), fps, snapshot['counters'].get('dropped_frames', 0),
+             snapshot['counters'].get('face_invokes', 0), snapshot['counters'].get('pose_invokes', 0)))
+    report_stages(snapshot, STAGES)
+
+
+def report_stages(snapshot, stages):
+    for stage in stages:
+        if stage in snapshot['stages']:
+            stats = snapshot['stages'][stage]
+            print('    %-16s p50 %7.2f ms   p90 %7.2f ms   p99 %7.2f ms'
+                  % (stage, stats['p50'] * 1000, stats['p90'] * 1000, stats['p99'] * 1000))
+
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('source', help='MJPEG file, image directory or glob pattern of images')
+    parser.add_argument('--script', choices=('cameraStream', 'follow_line', 'coralPose'), default='cameraStream',
+                        help='Which processing to measure')
+    parser.add_argument('--frames', type=int, default=None, help='Maximum number of frames to load')
+    parser.add_argument('--resolution', type=parse_resolution, default=(640, 480), help='e.g. 640x480')
+    parser.add_argument('--analysis-resolution', type=parse_resolution, default=None,
+                        help='Dual-resolution mode, e.g. 320x240')
+    parser.add_argument('--capture-mode', choices=('yuv', 'mjpeg'), default='yuv')
+    parser.add_argument('--detect-interval', type=int, default=5, help='1 disables the face tracking')
+    parser.add_argument('--face-latency', type=float, default=0.002, help='Emulated Edge TPU time [s]')
+    parser.add_argument('--pose-latency', type=float, default=0.013, help='Emulated Edge TPU time [s]')
+    parser.add_argument('--realtime', type=float, default=None, metavar='SECONDS',
+                        help='Replay at the camera frame rate for this long instead of processing every frame once')
+    parser.add_argument('--framerate', type=int, default=24, help='Camera frame rate in realtime mode')
+    parser.add_argument('--target-fps', type=float, default=None,
+                        help='Frame time budget of the scheduler, by default every stage runs on every frame')
+    parser.add_argument('--pose-interval', type=int, default=1, help='Run the pose detection every n-th frame')
+    parser.add_argument('--inference-service', action='store_true',
+                        help='Run the stand-in models in a background thread, like cameraStream.py does')
+    parser.add_argument('--trace', default=None, help='Append the time stamps of every frame to this JSON lines file')
+    parser.add_argument('--json', default=None, help='Also write all results to this JSON file')
+    args = parser.parse_args()
+    # The stand-in interpreters come with their own copies of the pycoral helpers
+    vision.use_helpers(stand_ins)
+
+    frames = stand_ins.load_frames(args.source, args.resolution, args.frames)
+    print('Loaded %i frames of %ix%i px from %s' % (len(frames), args.resolution[0], args.resolution[1], args.source))
+
+    results = []
+    if args.script != 'cameraStream':
+        if args.script == 'follow_line':
+            metrics, fps = run_follow_line(frames, args)
+            stages = ('find_line', 'control')
+        else:
+            metrics, fps = run_coral_pose(frames, args)
+            stages = ('pose', 'draw')
+        snapshot = metrics.snapshot()
+        print('%s: %.1f fps, %i dropped frames' % (args.script, fps, snapshot['counters'].get('dropped_frames', 0)))
+        report_stages(snapshot, stages)
+        results.append({'script': args.script, 'fps': fps, 'metrics': snapshot})
+    for stages in stage_combinations() if args.script == 'cameraStream' else ():
+        if args.realtime is None:
+            metrics, fps = run_offline(frames, stages, args)
+        else:
+            metrics, fps = run_realtime(frames, stages, args)
+        snapshot = metrics.snapshot()
+        report(stages, snapshot, fps)
+        results.append({'stages': stages, 'fps': fps, 'metrics': snapshot})
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
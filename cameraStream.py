@@ -1,32 +1,94 @@
-import io
 import picamera  # Camera
-import os
 
 #### THIS IS IMPORTANT FOR LIFE STREAMING ####
 import logging
+import json
 import socketserver
-from threading import Condition
 from http import server
 
 #### THIS IS IMPORTANT FOR IMAGE PROCESSING ####
-import numpy as np
 import cv2
 
-### Imports for pose detector
-from pycoral.adapters import common
-from pycoral.utils.edgetpu import make_interpreter
-
-### other imports
-from datetime import datetime
-from datetime import timedelta
-from copy import deepcopy
-
-# Flags for different image processing modes; they can run simultaneously
+### Processing of the frames, in a background thread or in worker processes
+from pipeline import ProcessPipeline
+from processor import AnnotatedOutput, FrameProcessor
+from capture import YUVOutput
+from frame_buffer import FrameBuffer
+from async_server import AsyncStreamingServer
+from h264_stream import H264Output, h264_page
+from metrics import Metrics
+from models import LazyModel, load_interpreter
+from scheduler import StageScheduler
+from inference import InferenceService
+from latency import LatencyTracer, camera_clock
+
+# Flags for different image processing modes; they can run simultaneously. They are only the settings at startup,
+# the stages can be switched while the stream runs with POST /stages (see scheduler.py)
 DETECT_FACES = True
 SAVE_FACES = False
 RECOGNISE_FACES = True
 DETECT_POSES = False
 
+# Save the collected faces as PNG files to ../faces (None) or append them to a packed face store (see face_store.py),
+# labelled e.g. with the name of the person
+FACE_STORE = None  # e.g. '../faces.store'
+FACE_LABEL = None
+
+# Record every pose with its time stamp to a pose log directory (see pose_recorder.py), None disables the recording
+RECORD_POSES = None  # e.g. '../poses'
+
+# The age of every frame (capture -> streamed) is on /metrics as glass_to_glass; optionally every frame's time stamps of
+# all stages are also written to a trace file (one JSON line per frame)
+TRACE_FILE = None  # e.g. '../latency.jsonl'
+
+# Face tracking: run the full face detector only every DETECT_INTERVAL frames (or when a face got lost) and only
+# search around the last known face positions in between
+FACE_TRACKING = True
+DETECT_INTERVAL = 5
+
+# How the processing stages are run: 'thread' runs all stages after each other in one background thread,
+# 'process' runs decoding, detection, inference and encoding in separate processes on different CPU cores
+PIPELINE_MODE = 'thread'
+
+# How frames are taken from the camera: 'mjpeg' records JPEG frames that are decoded again for the processing,
+# 'yuv' records unencoded frames, so the processing needs no decoding and JPEG encoding only happens for the stream
+CAPTURE_MODE = 'yuv'
+
+# Which server streams the frames: 'thread' uses one thread per client (http.server), 'asyncio' serves all clients
+# from one event loop and always sends slow clients the newest frame instead of queueing
+SERVER_MODE = 'asyncio'
+
+# Additionally stream the camera's hardware encoded H.264 on /h264.html (asyncio server only). The detections are sent
+# along as JSON and drawn by the browser, and frames are only drawn and JPEG encoded while someone watches the MJPEG
+# stream. The viewer page loads its player (JMuxer) from unpkg.com, so the viewer's browser needs internet access.
+H264_STREAM = True
+H264_BITRATE = 2000000  # [bit/s]
+
+# Camera resolution (width, height) of the streamed frames and frame rate
+RESOLUTION = (640, 480)
+FRAMERATE = 24
+
+# Frame rate that the processing should keep up with. If a frame takes longer, pose detection, face recognition and
+# face detection run on fewer frames and the others reuse their results. None runs every enabled stage on every frame.
+TARGET_FPS = FRAMERATE
+
+# Run MoveNet only on every n-th frame, the pose is predicted from its movement on the frames in between
+POSE_INTERVAL = 2
+
+# Dual-resolution mode: detection and inference run on a small second stream from the camera's hardware resizer, while
+# the viewers get the frames at full RESOLUTION (which can then be raised). Set to None to analyse the streamed frames.
+# The aspect ratio can differ from RESOLUTION (e.g. the square input of the models), detections are scaled per axis.
+ANALYSIS_RESOLUTION = None  # e.g. (320, 240)
+
+# Minimum size [px] of a detected face in a 640x480 frame, depends on face-camera distance
+MIN_FACE_SIZE = 152
+
+# Files of the face detector and the Coral models. Compile both models together (edgetpu_compiler face.tflite
+# movenet.tflite), so the Edge TPU keeps the parameters of both and switching between them costs nothing.
+CASCADE_FILE = "haarcascade_frontalface_default.xml"
+FACE_MODEL = 'coral/face.tflite'
+POSE_MODEL = 'coral/movenet_single_pose_thunder_ptq_edgetpu.tflite'
+
 PAGE = """\
 <html>
 <head>
@@ -38,96 +100,34 @@ PAGE = """\
 </html>
 """
 
-# Initialize face detector
-det = cv2.CascadeClassifier("haarcascade_frontalface_default.xml")
-
-# Initialize face recognition
-face_interpreter = make_interpreter('coral/face.tflite')
-face_interpreter.allocate_tensors()
-
-# Initialize pose detector
-pose_interpreter = make_interpreter('coral/movenet_single_pose_thunder_ptq_edgetpu.tflite')
-pose_interpreter.allocate_tensors()
-
-# Set constants
-BORDER = 8  # Border size [px] of detected faces on stream
-_NUM_KEYPOINTS = 17  # Number of detection points for pose detection
-
-# Dictionary to map key points to joints of body parts
-KEYPOINT_DICT = {
-    'nose': 0,
-    'left_eye': 1,
-    'right_eye': 2,
-    'left_ear': 3,
-    'right_ear': 4,
-    'left_shoulder': 5,
-    'right_shoulder': 6,
-    'left_elbow': 7,
-    'right_elbow': 8,
-    'left_wrist': 9,
-    'right_wrist': 10,
-    'left_hip': 11,
-    'right_hip': 12,
-    'left_knee': 13,
-    'right_knee': 14,
-    'left_ankle': 15,
-    'right_ankle': 16
-}
-
-# Map bones (connection between certain key points) to colors
-KEYPOINT_EDGE_INDS_TO_COLOR = {
-    # Lines between nose, eyes and ears
-    (0, 1): (255, 0, 0),
-    (0, 2): (255, 0, 0),
-    (1, 3): (255, 0, 0),
-    (2, 4): (255, 0, 0),
-
-    # Lines of arms
-    (5, 7): (0, 255, 0),
-    (7, 9): (0, 255, 0),
-    (6, 8): (0, 255, 0),
-    (8, 10): (0, 255, 0),
-
-    # Lines of torso
-    (5, 6): (0, 0, 255),
-    (5, 11): (0, 0, 255),
-    (6, 12): (0, 0, 255),
-    (11, 12): (0, 0, 255),
-
-    # Lines of legs
-    (11, 13): (255, 255, 255),
-    (13, 15): (255, 255, 255),
-    (12, 14): (255, 255, 255),
-    (14, 16): (255, 255, 255)
-}
-
-
-class StreamingOutput(object):
-    def __init__(self):
-        self.frame = None
-        self.buffer = io.BytesIO()
-        self.condition = Condition()
-
-    def write(self, buf):
-        if buf.startswith(b'\xff\xd8'):
-            # New frame, copy the existing buffer's content and notify all
-            # clients it's available
-            self.buffer.truncate()
-            with self.condition:
-                self.frame = self.buffer.getvalue()
-                self.condition.notify_all()
-            self.buffer.seek(0)
-        return self.buffer.write(buf)
+# Timings of all processing stages, frame rate, dropped frames, clients and TPU invokes, served on /metrics
+metrics = Metrics()
 
+# Only the models of enabled stages are loaded, in the background, so the stream already starts without them. The
+# others are loaded when their stage is switched on. In the process pipeline, they are loaded inside the workers.
+det = face_interpreter = pose_interpreter = None
+if PIPELINE_MODE == 'thread':
+    # Initialize face detector
+    det = LazyModel(cv2.CascadeClassifier, CASCADE_FILE)
+    if DETECT_FACES:
+        det.start()
 
-class StreamingHandler(server.BaseHTTPRequestHandler):
-    frame_i = 0
-    # Initialize variable that stores time of last saved image (3 seconds ago to immediately start saving faces
-    second = datetime.now() - timedelta(seconds=3)
+    # Initialize face recognition
+    face_interpreter = LazyModel(load_interpreter, FACE_MODEL)
+    if DETECT_FACES and RECOGNISE_FACES:
+        face_interpreter.start()
 
-    # Look up the currently highest file name number and use it as the first file number to avoid overwriting
-    fnames = os.listdir("../faces")
-    face_i = np.max(np.array([int(f[5:8]) for f in fnames])) + 1
+    # Initialize pose detector
+    pose_interpreter = LazyModel(load_interpreter, POSE_MODEL)
+    if DETECT_POSES:
+        pose_interpreter.start()
+
+    # Both models run in a background thread that owns the Edge TPU, the processing thread only submits requests
+    inference = InferenceService({'face': face_interpreter, 'pose': pose_interpreter}, metrics=metrics)
+    inference.start()
+
+
+class StreamingHandler(server.BaseHTTPRequestHandler):
 
     def do_GET(self):
         if self.path == '/':
@@ -141,6 +141,20 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Content-Length', len(content))
             self.end_headers()
             self.wfile.write(content)
+        elif self.path in ('/metrics', '/metrics.json'):
+            if self.path == '/metrics':
+                content = metrics.to_prometheus().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4'
+            else:
+                content = metrics.to_json().encode('utf-8')
+                content_type = 'application/json'
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif self.path == '/stages':
+            self.send_json(scheduler.state())
         elif self.path == '/stream.mjpg':
             self.send_response(200)
             self.send_header('Age', 0)
@@ -148,153 +162,14 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Pragma', 'no-cache')
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
+            metrics.inc_gauge('clients')
+            annotated.add_viewer()
             try:
+                seq = 0
                 while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-
-                        ### The image is encoded in bytes,
-                        ### needs to be converted to e.g. numpy array
-                        frame = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8),
-                                             cv2.IMREAD_COLOR)
-
-                        ###############
-                        ## HERE CAN GO ALL IMAGE PROCESSING
-                        ###############
-
-                        ###############
-                        ## POSE DETECTION
-                        ###############
-
-                        if DETECT_POSES:
-                            # This resizes the RGB image
-                            resized_img = cv2.resize(frame, common.input_size(pose_interpreter))
-                            # Send resized image to Coral
-                            common.set_input(pose_interpreter, resized_img)
-
-                            # Do the job
-                            pose_interpreter.invoke()
-
-                            # Get the pose
-                            pose = common.output_tensor(pose_interpreter, 0).copy().reshape(_NUM_KEYPOINTS, 3)
-
-                        ###############
-                        ## FACE DETECTION
-                        ###############
-
-                        if DETECT_FACES:
-                            # Convert frame into greyscale for image processing
-                            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-                            # Use face detector to find all faces in the current frame
-                            # Output rects will be a list of tuples with x/y coordinates of the top-left corner of the
-                            # detected face rectangle and the width and height of the rectangle
-                            rects = det.detectMultiScale(gray,
-                                                         scaleFactor=1.1,
-                                                         # How much the image should be scaled down per processing layer
-                                                         minNeighbors=6,
-                                                         # Detection threshold (higher -> more certain faces are detected)
-                                                         minSize=(152, 152),
-                                                         # Minimum size of a detected face, depends on face-camera distance
-                                                         flags=cv2.CASCADE_SCALE_IMAGE)
-
-                            ### Save detected faces
-                            # Only start the saving process if the last face was saved more than 3 seconds ago
-                            if SAVE_FACES:
-                                current_second = datetime.now()
-                                if (current_second - self.second).seconds >= 3:
-
-                                    for (x, y, w, h) in rects:
-                                        if self.face_i > 999:  # Stop at 999 face images to avoid overwriting
-                                            break
-
-                                        # Crop out face from frame and resize it to a common size (128x128)
-                                        crop = frame[y + BORDER:y + h - BORDER, x + BORDER:x + w - BORDER]
-                                        cropscale = cv2.resize(crop, (128, 128))
-
-                                        # Compute variance of Laplacian convolution as measure of blurriness, with threshold
-                                        blurry = cv2.Laplacian(cropscale, cv2.CV_64F).var() < 150
-                                        if not blurry:
-                                            # print("BLURRY")
-                                            # cv2.imwrite("../faces_blurry/face_%03i.png" % self.face_i, cropscale)
-                                            # else:
-
-                                            # If variance is above threshold, save face with current face counter in filename
-                                            cv2.imwrite("../faces/face_%03i.png" % self.face_i, cropscale)
-                                            self.second = datetime.now()  # Remember time of saving to avoid saving too quickly
-                                            self.face_i += 1  # Increment face counter
-                                            print("saved face %i" % (self.face_i - 1))
-
-                        ##################################################
-                        ### DRAW DETECTIONS ON THE FRAME BEFORE STREAMING
-                        ##################################################
-
-                        if DETECT_FACES:
-
-                            if RECOGNISE_FACES:
-                                colors = []
-                                # For every detected face, check if it is from the trained person or not
-                                for (x, y, w, h) in rects:
-
-                                    # Crop out face from frame
-                                    face = frame[y + BORDER:y + h - BORDER, x + BORDER:x + w - BORDER]
-
-                                    # This resizes the RGB image
-                                    resized_face = cv2.resize(face, common.input_size(face_interpreter))
-                                    # Send resized image to Coral
-                                    common.set_input(face_interpreter, resized_face)
-
-                                    # Do the job
-                                    face_interpreter.invoke()
-
-                                    # Get result if face is recognised or not
-                                    recognized = common.output_tensor(face_interpreter, 0)
-
-                                    if recognized:
-                                        colors.append((0, 255, 0))
-                                    else:
-                                        colors.append((255, 0, 0))
-                            else:
-                                # If no face detection, all rectangles should be green
-                                colors = [(0, 255, 0)]*len(rects)
-
-                            ### DRAW RECTANGLE AROUND FACES
-                            # Go through all detected faces in the frame and draw a rectangle around it
-                            for idx, (x, y, w, h) in enumerate(rects):
-                                # x: x location
-                                # y: y location
-                                # w: width of the rectangle
-                                # h: height of the rectangle
-                                cv2.rectangle(frame, (x, y), (x + w, y + h), colors[idx], BORDER)
-
-                            # Put face counter on top of the streamed frame
-                            cv2.putText(frame, "%i" % (self.face_i - 1), (100, 100), cv2.FONT_HERSHEY_SIMPLEX, 2, 255)
-
-                        if DETECT_POSES:
-                            ### DRAW DOTS ON POSE KEYPOINTS
-                            height, width, ch = frame.shape
-
-                            # Draw the bones (lines between certain keypoints)
-                            for edgepair, color in KEYPOINT_EDGE_INDS_TO_COLOR.items():
-                                cv2.line(img=frame,
-                                         pt1=(int(pose[edgepair[0]][1] * width),
-                                              int(pose[edgepair[0]][0] * height)),
-                                         pt2=(int(pose[edgepair[1]][1] * width),
-                                              int(pose[edgepair[1]][0] * height)),
-                                         color=color,
-                                         thickness=int(np.round(BORDER*0.75)))
-
-                            # Draw the pose onto the image using cyan dots
-                            for i in range(0, _NUM_KEYPOINTS):
-                                cv2.circle(frame,
-                                           [int(pose[i][1] * width), int(pose[i][0] * height)],
-                                           BORDER,  # radius
-                                           (0, 255, 255),  # color in RGB
-                                           -1)  # fill the circle
-
-                        ### and now we convert it back to JPEG to stream it
-                        _, frame = cv2.imencode('.JPEG', frame)
+                    # The frame processor already did all the work, clients only wait for the next annotated JPEG.
+                    # A slow client directly gets the latest frame and skips the ones in between.
+                    seq, frame = annotated.wait(seq)
 
                     self.wfile.write(b'--FRAME\r\n')
                     self.send_header('Content-Type', 'image/jpeg')
@@ -306,25 +181,109 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
                 logging.warning(
                     'Removed streaming client %s: %s',
                     self.client_address, str(e))
+            finally:
+                metrics.inc_gauge('clients', -1)
+                annotated.add_viewer(-1)
         else:
             self.send_error(404)
             self.end_headers()
 
 
+    def do_POST(self):
+        path, _, query = self.path.partition('?')
+        if path == '/stages':
+            # Switch processing stages or the target frame rate, e.g. POST /stages?detect_poses=1&target_fps=12
+            try:
+                scheduler.configure(query)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            self.send_json(scheduler.state())
+        else:
+            self.send_error(404)
+
+    def send_json(self, data):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
     daemon_threads = True
 
 
+# Process every camera frame once in the background and share the result with all clients
+if CAPTURE_MODE == 'yuv':
+    output = YUVOutput(RESOLUTION)
+else:
+    output = FrameBuffer()
+h264 = None
+if H264_STREAM and SERVER_MODE == 'asyncio':
+    h264 = H264Output()
+annotated = AnnotatedOutput(encode_unwatched=h264 is None)
+
+# Small frames for detection and inference, and the minimum face size scaled to the analysed frames
+analysis = None
+analysis_resolution = RESOLUTION
+if ANALYSIS_RESOLUTION is not None:
+    analysis = YUVOutput(ANALYSIS_RESOLUTION)
+    analysis_resolution = ANALYSIS_RESOLUTION
+min_face_size = int(MIN_FACE_SIZE * min(analysis_resolution[0] / 640, analysis_resolution[1] / 480))
+
+stages = {'detect_faces': DETECT_FACES, 'save_faces': SAVE_FACES,
+          'recognise_faces': RECOGNISE_FACES, 'detect_poses': DETECT_POSES}
+scheduler = StageScheduler(stages, TARGET_FPS, min_intervals={'detect_poses': POSE_INTERVAL}, metrics=metrics)
+tracer = LatencyTracer(metrics, TRACE_FILE)
+if PIPELINE_MODE == 'process':
+    processor = ProcessPipeline(output, annotated, (RESOLUTION[1], RESOLUTION[0], 3), stages,
+                                CASCADE_FILE, FACE_MODEL, POSE_MODEL,
+                                detect_interval=DETECT_INTERVAL if FACE_TRACKING else 1,
+                                capture_mode=CAPTURE_MODE, analysis=analysis, min_face_size=min_face_size,
+                                face_store=FACE_STORE, face_label=FACE_LABEL, pose_log=RECORD_POSES,
+                                scheduler=scheduler, metrics=metrics, tracer=tracer)
+else:
+    processor = FrameProcessor(output, annotated, stages, det, face_interpreter, pose_interpreter,
+                               capture_mode=CAPTURE_MODE, analysis=analysis, min_face_size=min_face_size,
+                               detect_interval=DETECT_INTERVAL if FACE_TRACKING else 1,
+                               face_store=FACE_STORE, face_label=FACE_LABEL, pose_log=RECORD_POSES,
+                               scheduler=scheduler, metrics=metrics, tracer=tracer, inference=inference)
+# Start the processing before the camera is opened, so worker processes don't inherit the camera
+processor.start()
+
 # Open the camera and stream a low-res image (width 640, height 480 px)
-with picamera.PiCamera(resolution='640x480', framerate=24) as camera:
+# clock_mode='raw' puts the frame timestamps on the camera's clock, see latency.camera_clock
+with picamera.PiCamera(resolution=RESOLUTION, framerate=FRAMERATE, clock_mode='raw') as camera:
     camera.vflip = True  # Flips image vertically, depends on your camera mounting
     camera.awb_mode = "auto"
-    output = StreamingOutput()
-    camera.start_recording(output, format='mjpeg')
+    # The outputs take the capture time of every frame from the camera's frame timestamps
+    output.clock = camera_clock(camera)
+    camera.start_recording(output, format=CAPTURE_MODE)
+    if analysis is not None:
+        analysis.clock = camera_clock(camera, splitter_port=2)
+        # Second stream on another splitter port, downscaled by the GPU instead of cv2.resize
+        camera.start_recording(analysis, format='yuv', splitter_port=2, resize=ANALYSIS_RESOLUTION)
+    if h264 is not None:
+        # Baseline profile with the headers before every key frame (once per second), so browsers can join any time
+        camera.start_recording(h264, format='h264', splitter_port=3, profile='baseline', inline_headers=True,
+                               intra_period=FRAMERATE, bitrate=H264_BITRATE)
+        h264.request_key_frame = lambda: camera.request_key_frame(splitter_port=3)
     try:
         address = ('', 8000)  # port 8000
-        server = StreamingServer(address, StreamingHandler)
+        if SERVER_MODE == 'asyncio':
+            server = AsyncStreamingServer(annotated, PAGE, address, metrics=metrics, scheduler=scheduler, h264=h264,
+                                          h264_page=h264_page(FRAMERATE))
+        else:
+            server = StreamingServer(address, StreamingHandler)
         server.serve_forever()
     finally:
+        if h264 is not None:
+            camera.stop_recording(splitter_port=3)
+        if analysis is not None:
+            camera.stop_recording(splitter_port=2)
         camera.stop_recording()
+        processor.stop()
+        tracer.close()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Camera outputs for unencoded frames.
+
+Recording in 'yuv' format gives the raw YUV420 (I420) frames of the camera. They are copied straight into
+preallocated numpy buffers, so the analysis needs no JPEG decoding, and the greyscale image for the face detector is
+simply the Y plane of the frame. The capture time of every frame is kept for the latency tracing (see latency.py).
+"""
+
+import time
+from collections import deque
+from threading import Condition
+
+import numpy as np
+import cv2
+
+
+class YUVOutput(object):
+    """Buffer object where the camera writes unencoded YUV420 frames into and the script can read them out again."""
+
+    def __init__(self, resolution, n_buffers=3):
+        self.width, self.height = resolution
+        # The camera pads the frames to a width of a multiple of 32 and a height of a multiple of 16
+        self.fwidth = (self.width + 31) // 32 * 32
+        self.fheight = (self.height + 15) // 16 * 16
+        self.frame_size = self.fwidth * self.fheight * 3 // 2
+
+        # Preallocated frame buffers, the camera writes into them in turn
+        self.buffers = [np.empty(self.frame_size, dtype=np.uint8) for _ in range(n_buffers)]
+        self.index = 0  # Buffer that is currently written
+        self.offset = 0  # Number of bytes of the current frame that are already written
+        self.locked = None  # Buffer that is currently used by the consumer and must not be overwritten
+
+        self.frame = None  # Latest complete frame
+        self.seq = 0  # Sequence number of the latest complete frame (0 -> no frame yet)
+        self.condition = Condition()
+
+        self.clock = None  # Function that returns the capture time of the current frame, e.g. latency.camera_clock
+        self.capture_times = deque(maxlen=2 * n_buffers)  # (seq, capture time) of the latest frames
+
+    def write(self, buf):
+        # A frame can arrive in several pieces, so copy them into the current buffer until it is full
+        data = np.frombuffer(buf, dtype=np.uint8)
+        written = 0
+        while written < len(data):
+            n = min(len(data) - written, self.frame_size - self.offset)
+            self.buffers[self.index][self.offset:self.offset + n] = data[written:written + n]
+            self.offset += n
+            written += n
+
+            if self.offset == self.frame_size:
+                # Complete frame, notify all consumers and continue with a buffer that nobody is reading
+                capture = self.clock() if self.clock is not None else time.monotonic()
+                with self.condition:
+                    self.frame = self.buffers[self.index]
+                    self.seq += 1
+                    self.capture_times.append((self.seq, capture))
+                    self.condition.notify_all()
+                    self.index = self._next_index()
+                self.offset = 0
+        return len(buf)
+
+    def _next_index(self):
+        for step in range(1, len(self.buffers) + 1):
+            index = (self.index + step) % len(self.buffers)
+            if self.buffers[index] is not self.frame and self.buffers[index] is not self.locked:
+                return index
+        return (self.index + 1) % len(self.buffers)
+
+    def wait(self, last_seq, timeout=None):
+        """Blocks until there is a frame newer than last_seq and returns (seq, frame, number of missed frames)."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > last_seq, timeout)
+            return self.seq, self.frame, max(0, self.seq - last_seq - 1)
+
+    def capture_time(self, seq):
+        """Capture time of the frame with this sequence number, or None if it is not known anymore."""
+        with self.condition:
+            for frame_seq, capture in self.capture_times:
+                if frame_seq == seq:
+                    return capture
+        return None
+
+    def acquire(self):
+        """Returns the latest frame and protects it from being overwritten until release() is called."""
+        with self.condition:
+            self.locked = self.frame
+            return self.frame
+
+    def release(self):
+        with self.condition:
+            self.locked = None
+
+    def gray(self, frame):
+        """Greyscale image of a frame, which is a view on the Y plane without any conversion."""
+        return frame[:self.fwidth * self.fheight].reshape(self.fheight, self.fwidth)[:self.height, :self.width]
+
+    def chroma(self, frame):
+        """U and V plane of a frame (half width and height), which are views without any conversion."""
+        y_size = self.fwidth * self.fheight
+        u = frame[y_size:y_size * 5 // 4].reshape(self.fheight // 2, self.fwidth // 2)
+        v = frame[y_size * 5 // 4:].reshape(self.fheight // 2, self.fwidth // 2)
+        return u[:self.height // 2, :self.width // 2], v[:self.height // 2, :self.width // 2]
+
+    def bgr(self, frame):
+        """Converts a frame into a new BGR image, which is needed to draw and stream in color."""
+        bgr = cv2.cvtColor(frame.reshape(self.fheight * 3 // 2, self.fwidth), cv2.COLOR_YUV2BGR_I420)
+        # Cut off the padding, OpenCV can only draw into contiguous arrays
+        return np.ascontiguousarray(bgr[:self.height, :self.width])
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Packed face data set: all face crops in a few large, memory-mappable arrays instead of thousands of small PNGs.
+
+The crops are appended into shards of fixed-shape uint8 arrays (.npy files of shard_size faces each), next to a
+structured metadata array per shard (time stamp, blur score, source rectangle and label). index.json holds the shape,
+the number of faces and the label names. For training and evaluation the shards are memory-mapped, so tens of
+thousands of faces can be iterated over at disk speed without opening and decoding a file per face.
+
+    python face_store.py import ../faces ../faces.store --label hendrik
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import cv2
+
+INDEX_FILE = 'index.json'
+SHARD_PATTERN = 'faces_%05i.npy'
+META_PATTERN = 'faces_%05i.meta.npy'
+
+# Metadata of every face, label -1 means unlabelled
+META_DTYPE = np.dtype([('timestamp', 'f8'), ('blur', 'f4'),
+                       ('x', 'i4'), ('y', 'i4'), ('w', 'i4'), ('h', 'i4'),
+                       ('label', 'i2')])
+
+
+class FaceStore(object):
+    """Append-only store of face crops in sharded .npy files. Open with mode 'a' to add faces or 'r' to read them."""
+
+    def __init__(self, directory, mode='a', shape=(128, 128, 3), shard_size=4096):
+        self.directory = directory
+        self.mode = mode
+        self._shards = {}  # Shard number -> (faces, metadata) memory maps
+
+        index_file = os.path.join(directory, INDEX_FILE)
+        if os.path.exists(index_file):
+            # Shape and shard size of an existing store always win over the arguments
+            with open(index_file) as f:
+                index = json.load(f)
+            self.shape = tuple(index['shape'])
+            self.shard_size = index['shard_size']
+            self.count = index['count']
+            self.labels = index['labels']  # Label names, the metadata stores their position in this list
+        elif mode == 'r':
+            raise FileNotFoundError('No face store in %s' % directory)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.shape = tuple(shape)
+            self.shard_size = shard_size
+            self.count = 0
+            self.labels = []
+            self.flush()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        """Returns (face, metadata) of the i-th face, the face is a view on the memory map."""
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('Face %i out of range' % i)
+        faces, meta = self._shard(i // self.shard_size)
+        return faces[i % self.shard_size], meta[i % self.shard_size]
+
+    def _shard(self, n):
+        if n not in self._shards:
+            face_file = os.path.join(self.directory, SHARD_PATTERN % n)
+            meta_file = os.path.join(self.directory, META_PATTERN % n)
+            if os.path.exists(face_file):
+                file_mode = 'r' if self.mode == 'r' else 'r+'
+                self._shards[n] = (np.lib.format.open_memmap(face_file, mode=file_mode),
+                                   np.lib.format.open_memmap(meta_file, mode=file_mode))
+            else:
+                # New shards are allocated at full size at once, the unused part of the file stays sparse
+                self._shards[n] = (np.lib.format.open_memmap(face_file, mode='w+', dtype=np.uint8,
+                                                             shape=(self.shard_size,) + self.shape),
+                                   np.lib.format.open_memmap(meta_file, mode='w+', dtype=META_DTYPE,
+                                                             shape=(self.shard_size,)))
+        return self._shards[n]
+
+    def label_id(self, label):
+        if label is None:
+            return -1
+        if label not in self.labels:
+            self.labels.append(label)
+        return self.labels.index(label)
+
+    def append(self, face, blur=0.0, rect=(0, 0, 0, 0), label=None, timestamp=None):
+        """Adds one face crop (resized to the shape of the store if needed) and returns its index."""
+        if self.mode == 'r':
+            raise IOError('Face store %s is opened read-only' % self.directory)
+        if face.shape != self.shape:
+            face = cv2.resize(face, (self.shape[1], self.shape[0]))
+
+        faces, meta = self._shard(self.count // self.shard_size)
+        i = self.count % self.shard_size
+        faces[i] = face
+        meta[i] = (time.time() if timestamp is None else timestamp, blur) + tuple(rect) + (self.label_id(label),)
+        self.count += 1
+        return self.count - 1
+
+    def flush(self):
+        """Writes the faces to disk and updates the index, afterwards readers see all appended faces."""
+        for faces, meta in self._shards.values():
+            faces.flush()
+            meta.flush()
+        index = {'shape': list(self.shape), 'shard_size': self.shard_size, 'count': self.count,
+                 'labels': self.labels}
+        # Replace the index atomically, so a reader never sees a half-written file
+        tmp_file = os.path.join(self.directory, INDEX_FILE + '.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, os.path.join(self.directory, INDEX_FILE))
+
+    def close(self):
+        if self.mode != 'r':
+            self.flush()
+        self._shards = {}
+
+    def iter_batches(self, batch_size=256):
+        """Yields (faces, metadata) batches over all faces. The batches are views on the memory maps, so nothing is
+        copied or decoded; they never span two shards and may therefore be smaller than batch_size."""
+        for start in range(0, self.count, self.shard_size):
+            faces, meta = self._shard(start // self.shard_size)
+            n = min(self.shard_size, self.count - start)
+            for i in range(0, n, batch_size):
+                yield faces[i:min(n, i + batch_size)], meta[i:min(n, i + batch_size)]
+
+    def metadata(self):
+        """Returns the metadata of all faces as one structured array."""
+        return np.concatenate([meta for _, meta in self.iter_batches(self.shard_size)] or
+                              [np.empty(0, dtype=META_DTYPE)])
+
+
+def import_images(directory, store, label=None):
+    """Appends all PNG/JPEG faces of a directory (e.g. the ones collected by FaceWriter) to a store."""
+    fnames = sorted(f for f in os.listdir(directory) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+    for fname in fnames:
+        face = cv2.imread(os.path.join(directory, fname))
+        if face is not None:
+            store.append(face, cv2.Laplacian(face, cv2.CV_64F).var(), label=label,
+                         timestamp=os.path.getmtime(os.path.join(directory, fname)))
+    store.flush()
+    return len(fnames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tools for the packed face data set')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='Append a directory of face images to a store')
+    import_parser.add_argument('images')
+    import_parser.add_argument('store')
+    import_parser.add_argument('--label', default=None)
+    info_parser = subparsers.add_parser('info', help='Print the size and labels of a store')
+    info_parser.add_argument('store')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        store = FaceStore(args.store)
+        n = import_images(args.images, store, args.label)
+        store.close()
+        print('Imported %i faces, the store now holds %i' % (n, len(store)))
+    else:
+        store = FaceStore(args.store, mode='r')
+        labels = store.metadata()['label']
+        print('%i faces of shape %s' % (len(store), store.shape))
+        for i, name in enumerate(store.labels):
+            print('    %s: %i' % (name, np.count_nonzero(labels == i)))
+        print('    unlabelled: %i' % np.count_nonzero(labels == -1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Background writer that collects face crops for the training data set.
+
+The stream only crops the detected faces and hands them over to a bounded queue, which costs next to nothing. A
+background thread takes the crops in batches, drops blurry ones and near-duplicates (by a perceptual difference hash)
+and writes the rest as PNG files, or appends them to a packed FaceStore (see face_store.py). If the writer falls
+behind, new crops are dropped instead of ever blocking the stream.
+"""
+
+import logging
+import os
+import queue
+import re
+import time
+from collections import deque
+from threading import Thread
+
+import numpy as np
+import cv2
+
+import vision
+
+# File names of the saved faces, e.g. face_042.png (numbers above 999 simply get more digits)
+FILE_PATTERN = "face_%03i.png"
+FILE_REGEX = re.compile(r'^face_(\d+)\.png$')
+
+
+def next_index(directory):
+    """Returns the number after the highest face file number in the directory, so no file gets overwritten. Files
+    that don't follow the naming scheme are ignored."""
+    numbers = [int(m.group(1)) for m in map(FILE_REGEX.match, os.listdir(directory)) if m is not None]
+    return max(numbers) + 1 if numbers else 1
+
+
+def dhash(img, hash_size=8):
+    """Difference hash of an image as 64-bit integer: similar images have hashes that differ in only a few bits."""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(img, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class FaceWriter(Thread):
+    """Saves sharp, distinct crops of detected faces to disk without blocking the stream."""
+
+    def __init__(self, directory="../faces", size=(128, 128), min_gap=3.0, blur_threshold=150, max_distance=6,
+                 n_hashes=256, max_queue=32, batch_size=8, store=None, label=None, metrics=None):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.size = size  # All faces are resized to this common size (width, height)
+        self.min_gap = min_gap  # Minimum time [s] between two saved frames
+        self.blur_threshold = blur_threshold  # Minimum variance of the Laplacian, blurrier faces are not saved
+        self.max_distance = max_distance  # Faces whose hash differs in at most this many bits are duplicates
+        self.batch_size = batch_size  # Maximum number of crops that are handled per wake-up of the thread
+        self.store = store  # Optional FaceStore that the faces are appended to instead of saving PNG files
+        self.label = label  # Label of the faces in the store, e.g. the name of the person that is collected
+        self.metrics = metrics  # Optional Metrics that count the saved and skipped faces
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.hashes = deque(maxlen=n_hashes)  # Hashes of the recently saved faces
+        self.last_saved = 0.0  # Time of the last saved face
+
+        # Look up the currently highest file name number once, afterwards the writer counts itself
+        if self.store is not None:
+            self.face_i = len(self.store) + 1
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            self.face_i = next_index(self.directory)  # Number of the next saved face
+
+    def submit(self, frame, rects):
+        """Hands the faces of a frame over to the writer. Only crops and copies them, everything else happens in
+        the background."""
+        now = time.monotonic()
+        if not rects or now - self.last_saved < self.min_gap:
+            return
+        for rect in rects:
+            # Copy the crop, the frame buffer is reused for the next camera frame
+            crop = cv2.resize(vision.crop_face(frame, rect), self.size)
+            try:
+                self.queue.put_nowait((crop, rect, now))
+            except queue.Full:
+                self._count('dropped_faces')
+
+    def stop(self):
+        """Writes the remaining faces and stops the thread."""
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            # Block for the first crop, then take everything else that is waiting (up to the batch size)
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(item is None for item in batch)
+            for item in batch:
+                if item is not None:
+                    try:
+                        self._write(*item)
+                    except Exception as e:
+                        logging.warning('Could not save face: %s', str(e))
+            if self.store is not None:
+                # Make the new faces visible to readers of the store once per batch instead of once per face
+                self.store.flush()
+            if stop:
+                break
+
+    def _write(self, crop, rect, submitted):
+        # Frames that were queued before the last save are checked again, so faces are not saved faster than one
+        # frame per min_gap (all faces of the same frame have the same time and are saved together)
+        if 0 < submitted - self.last_saved < self.min_gap:
+            self._count('skipped_faces')
+            return
+
+        # Compute variance of Laplacian convolution as measure of blurriness, with threshold
+        blur = cv2.Laplacian(crop, cv2.CV_64F).var()
+        if blur < self.blur_threshold:
+            self._count('blurry_faces')
+            return
+
+        # Skip faces that look (almost) the same as a recently saved one
+        h = dhash(crop)
+        if any(hamming(h, other) <= self.max_distance for other in self.hashes):
+            self._count('duplicate_faces')
+            return
+
+        if self.store is not None:
+            self.store.append(crop, blur, rect, self.label)
+        else:
+            cv2.imwrite(os.path.join(self.directory, FILE_PATTERN % self.face_i), crop)
+        self.hashes.append(h)
+        self.last_saved = submitted  # Remember time of the saved frame to avoid saving too quickly
+        self.face_i += 1  # Increment face counter
+        self._count('saved_faces')
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.count(name)
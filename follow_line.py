@@ -1,79 +1,192 @@
-import curses
-import serial
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Closed-loop line follower.
+
+The camera records small raw YUV frames, of which only a few horizontal bands of the color planes are looked at: pixels
+whose color (U, V) is close to the line color are counted per column in all bands at once, and the center of the
+counts gives the position of the line in each band. The lowest band gives the lateral offset of the line in front of
+the robot, the slope through all bands its heading. Both are turned into a steering value, whose change per second is
+limited, and sent as wheel speeds with the binary protocol of serial_client.py. Frames that arrive while one is still
+processed are skipped, so the steering always reacts to the newest frame. The age of every frame when its command is
+sent (glass-to-actuator latency) is printed at the end and optionally traced to a file (see latency.py).
+"""
+
 import time
-import picamera
-import io
-from threading import Condition
+
 import numpy as np
 import cv2
 
-# Color of the line that the robot should follow
+import latency
+from capture import YUVOutput
+from metrics import Metrics
+
+# Color of the line that the robot should follow (BGR)
 COLOR = (255, 0, 0)
+# Maximum summed difference of U and V to the line color for a pixel to count as line
+TOLERANCE = 40
+
+# The line is searched in small frames, which the camera scales down for free
+RESOLUTION = (640, 480)
+FRAMERATE = 40
+ANALYSIS_RESOLUTION = (160, 128)
+
+# Center of the bands relative to the frame height (the lowest band first) and their height in color plane rows
+BANDS = (0.9, 0.7, 0.5)
+BAND_HEIGHT = 4
+MIN_PIXELS = 6  # A band needs at least this many line pixels, otherwise the line counts as not found there
+
+# Controller
+SPEED = 160  # PWM of both wheels when the line is straight ahead
+KP = 0.8  # Steering per lateral offset (-1 left edge .. 1 right edge)
+KH = 0.5  # Steering per heading [rad]
+MAX_STEER_RATE = 4.0  # Maximum change of the steering per second, which avoids jerky turns on noisy frames
+SLOWDOWN = 0.5  # Speed reduction in sharp turns (relative to SPEED at full steering)
+LOST_TIMEOUT = 0.5  # Keep the last steering this long [s] after the line was lost, then stop
+ACK_INTERVAL = 10  # Ask the Arduino for an acknowledgement every n-th frame, for the latency statistics
+
+# Write the time stamps of every frame (capture, line found, command sent) to this file, one JSON line per frame
+TRACE_FILE = None  # e.g. '../follow_latency.jsonl'
+
+
+def target_chroma(color):
+    """U and V of a BGR color, with the same conversion that the camera frames are decoded with."""
+    yuv = cv2.cvtColor(np.full((2, 2, 3), color, dtype=np.uint8), cv2.COLOR_BGR2YUV_I420).ravel()
+    return int(yuv[4]), int(yuv[5])
+
+
+def band_rows(height, bands=BANDS, band_height=BAND_HEIGHT):
+    """Row indices of all bands in a plane of the given height: (n_bands, band_height)."""
+    centers = (np.asarray(bands) * height).astype(int)
+    rows = centers[:, None] + np.arange(band_height) - band_height // 2
+    return np.clip(rows, 0, height - 1)
+
+
+def find_line(u, v, rows, chroma, tolerance=TOLERANCE, min_pixels=MIN_PIXELS):
+    """Finds the line in all bands of the U and V plane at once. Returns the lateral offset (-1..1) in the lowest band
+    that sees the line and the heading [rad, positive -> the line bends to the right], or None for both if the line
+    is not found."""
+    # (n_bands, band_height, width) -> line pixels per band and column
+    diff = np.abs(u[rows].astype(np.int16) - chroma[0]) + np.abs(v[rows].astype(np.int16) - chroma[1])
+    counts = np.count_nonzero(diff < tolerance, axis=1)
+
+    width = u.shape[1]
+    n = counts.sum(axis=1)
+    found = n >= min_pixels
+    if not found.any():
+        return None, None
+    centers = counts[found] @ np.arange(width) / n[found]
+    offset = (centers[0] - width / 2) / (width / 2)
+
+    heading = 0.0
+    if np.count_nonzero(found) > 1:
+        # Least squares slope of the line position over the distance from the lowest band (pixels in both directions)
+        ys = rows[0, 0] - rows[found, 0]
+        xs = centers - centers.mean()
+        slope = (xs * (ys - ys.mean())).sum() / ((ys - ys.mean()) ** 2).sum()
+        heading = float(np.arctan(slope))
+    return float(offset), heading
+
+
+class LineController(object):
+    """Turns offset and heading of the line into wheel speeds, with a limited rate of change of the steering."""
+
+    def __init__(self, speed=SPEED, kp=KP, kh=KH, max_rate=MAX_STEER_RATE, slowdown=SLOWDOWN,
+                 lost_timeout=LOST_TIMEOUT):
+        self.speed = speed
+        self.kp = kp
+        self.kh = kh
+        self.max_rate = max_rate
+        self.slowdown = slowdown
+        self.lost_timeout = lost_timeout
+
+        self.steer = 0.0  # Current steering (-1 sharp left .. 1 sharp right)
+        self.t = None  # Time of the last update
+        self.last_seen = None  # Time the line was last found
+
+    def update(self, offset, heading, t):
+        """Returns (left, right) PWM for the line found at time t (offset None -> line not found)."""
+        dt = 0 if self.t is None else t - self.t
+        self.t = t
+        if offset is None:
+            if self.last_seen is None or t - self.last_seen > self.lost_timeout:
+                self.steer = 0.0
+                return 0, 0
+            target = self.steer  # Keep turning the way we did, the line is probably just out of view
+        else:
+            self.last_seen = t
+            target = float(np.clip(self.kp * offset + self.kh * heading, -1, 1))
+
+        if self.max_rate is None:
+            self.steer = target
+        else:
+            step = self.max_rate * dt
+            self.steer += min(max(target - self.steer, -step), step)
+
+        speed = self.speed * (1 - self.slowdown * abs(self.steer))
+        return int(speed * (1 + self.steer)), int(speed * (1 - self.steer))
+
+
+def main():
+    # Imported here, so find_line and LineController can also be used off the robot (see benchmark.py)
+    import picamera
+    from serial_client import SerialClient
+
+    chroma = target_chroma(COLOR)
+    rows = band_rows(ANALYSIS_RESOLUTION[1] // 2)
+    controller = LineController()
+    metrics = Metrics()
+    tracer = latency.LatencyTracer(metrics, TRACE_FILE)
+
+    # Open serial port, commands are sent without waiting for the Arduino's answer
+    client = SerialClient('/dev/ttyUSB0', 19200, protocol='binary', metrics=metrics)
+
+    # Open the camera and record small raw frames. Everything happens inside the with block, the camera stops
+    # recording when it is left. clock_mode='raw' puts the frame timestamps on the camera's clock (see latency.py).
+    with picamera.PiCamera(resolution=RESOLUTION, framerate=FRAMERATE, clock_mode='raw') as camera:
+        camera.vflip = True  # Flips image vertically, depends on your camera mounting
+        camera.awb_mode = "auto"
+        output = YUVOutput(ANALYSIS_RESOLUTION)
+        output.clock = latency.camera_clock(camera)
+        camera.start_recording(output, format='yuv', resize=ANALYSIS_RESOLUTION)
+
+        try:
+            seq = 0
+            while True:
+                # Wait for the next frame, frames that arrived in the meantime are skipped
+                seq, frame, missed = output.wait(seq)
+                metrics.count('dropped_frames', missed)
+                start = time.perf_counter()
+                trace = tracer.begin(seq, output.capture_time(seq))
+
+                raw = output.acquire()
+                try:
+                    u, v = output.chroma(raw)
+                    offset, heading = find_line(u, v, rows, chroma)
+                finally:
+                    output.release()
+                latency.mark(trace, 'find_line')
+
+                left, right = controller.update(offset, heading, time.monotonic())
+                client.drive(left, right, ack=seq % ACK_INTERVAL == 0)
+                tracer.finish(trace, 'glass_to_actuator')
+                metrics.observe('control', time.perf_counter() - start)
+                metrics.frame_published()
+
+        # Happens when the script is stopped, e.g. through KeyboardInterrupt
+        finally:
+            camera.stop_recording()
+            # Halt the robot
+            client.stop()
+            snapshot = metrics.snapshot()
+            print('%.1f fps, control %s, serial round trip %s' % (snapshot['fps'], snapshot['stages'].get('control'),
+                                                                  client.latency()))
+            print('glass to actuator %s, queueing %s' % (snapshot['stages'].get('glass_to_actuator'),
+                                                         snapshot['stages'].get('queue_delay')))
+            # Close serial port
+            client.close()
+            tracer.close()
+
 
-# Configure serial port
-ser = serial.Serial()
-ser.baudrate = 19200
-ser.port = '/dev/ttyUSB0'
-
-# Open serial port
-ser.open()
-time.sleep(2.00)  # Wait for connection before sending any data
-
-# List stores feedback from the Arduino
-arduino = []
-
-
-class StreamingOutput(object):
-    """Buffer object where the camera writes frames into and the script can read them out again."""
-
-    def __init__(self):
-        self.frame = None
-        self.buffer = io.BytesIO()
-        self.condition = Condition()
-
-    def write(self, buf):
-        if buf.startswith(b'\xff\xd8'):
-            # New frame, copy the existing buffer's content and notify all
-            # clients it's available
-            self.buffer.truncate()
-            with self.condition:
-                self.frame = self.buffer.getvalue()
-                self.condition.notify_all()
-            self.buffer.seek(0)
-        return self.buffer.write(buf)
-
-
-# Open the camera and stream a low-res image (width 640, height 480 px)
-with picamera.PiCamera(resolution='640x480', framerate=24) as camera:
-    camera.vflip = True  # Flips image vertically, depends on your camera mounting
-    camera.awb_mode = "auto"
-    output = StreamingOutput()
-    camera.start_recording(output, format='mjpeg')
-
-try:
-    while True:
-        with output.condition:
-            output.condition.wait()
-            # Read current frame from buffer
-            frame = output.frame
-            # Decode from bytes to numpy array
-            frame = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8),
-                                 cv2.IMREAD_COLOR)
-
-            print(np.mean(frame))
-
-            # # char is the unicode integer of the key, so transform it back into the string character before formatting
-            # var_char = '{}0;'.format(chr(char))
-            # ser.write(var_char.encode('utf-8'))  # Arduino expects a byte instead of a string, encode before sending it
-            # time.sleep(0.05)
-            # arduino.append(ser.readline())
-            # arduino.append(ser.readline())
-
-# Happens when the script is stopped, e.g. through KeyboardInterrupt
-finally:
-    # Send "t" for terminate to halt the robot
-    ser.write(b't0;')
-    arduino.append(ser.readline())
-    arduino.append(ser.readline())
-    # Close serial port
-    ser.close()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Zero-copy frame buffer that the camera writes its MJPEG frames into.
+
+The frames are written into a small ring of preallocated bytearrays, so there is no per-frame allocation. Every
+complete frame gets a sequence number. Consumers get a memoryview on the latest frame instead of a copy, and can tell
+from the sequence numbers if they missed frames (and skip them instead of queueing up). A frame is published as soon
+as its last byte arrived, and its capture time is kept for the latency tracing (see latency.py).
+"""
+
+import time
+from collections import deque
+from threading import Condition
+
+
+class FrameBuffer(object):
+    """Buffer object where the camera writes frames into and the scripts can read them out again."""
+
+    def __init__(self, n_slots=4, capacity=256 * 1024):
+        self.slots = [bytearray(capacity) for _ in range(n_slots)]
+        self.lengths = [0] * n_slots  # Size of the frame in each slot
+        self.seqs = [0] * n_slots  # Sequence number of the frame in each slot
+        self.index = 0  # Slot that the camera currently writes into
+        self.length = 0  # Number of bytes of the current frame that are already written
+
+        self.seq = 0  # Sequence number of the latest complete frame (0 -> no frame yet)
+        self.latest = None  # Slot of the latest complete frame
+        self.condition = Condition()
+
+        self.clock = None  # Function that returns the capture time of the current frame, e.g. latency.camera_clock
+        self.capture_times = deque(maxlen=2 * n_slots)  # (seq, capture time) of the latest frames
+
+    def write(self, buf):
+        if buf.startswith(b'\xff\xd8'):
+            # New frame, publish the one in the current slot and notify all clients it's available
+            self._publish()
+
+        n = len(buf)
+        slot = self.slots[self.index]
+        if self.length + n > len(slot):
+            # Rare case of a frame larger than the slot: replace the slot instead of resizing it, because a consumer
+            # might still hold a memoryview on the old one
+            new_slot = bytearray(max(2 * len(slot), self.length + n))
+            new_slot[:self.length] = slot[:self.length]
+            self.slots[self.index] = slot = new_slot
+        slot[self.length:self.length + n] = buf
+        self.length += n
+        if buf.endswith(b'\xff\xd9'):
+            # End of image marker: the frame is complete, don't wait for the start of the next one to publish it
+            self._publish()
+        return n
+
+    def flush(self):
+        # Called by picamera when the recording stops, publishes the last frame
+        self._publish()
+
+    def _publish(self):
+        if self.length == 0:
+            return
+        capture = self.clock() if self.clock is not None else time.monotonic()
+        with self.condition:
+            self.seq += 1
+            self.capture_times.append((self.seq, capture))
+            self.seqs[self.index] = self.seq
+            self.lengths[self.index] = self.length
+            self.latest = self.index
+            self.condition.notify_all()
+        # Continue in the oldest slot, which gives consumers of the latest frames the most time to read them
+        self.index = (self.index + 1) % len(self.slots)
+        self.length = 0
+
+    def read(self):
+        """Returns the sequence number and a memoryview of the latest complete frame, or (0, None) if there is none."""
+        with self.condition:
+            if self.latest is None:
+                return 0, None
+            return self.seq, memoryview(self.slots[self.latest])[:self.lengths[self.latest]]
+
+    def wait(self, last_seq, timeout=None):
+        """Blocks until there is a frame newer than last_seq and returns (seq, frame, number of missed frames)."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > last_seq, timeout)
+        seq, frame = self.read()
+        return seq, frame, max(0, seq - last_seq - 1)
+
+    def capture_time(self, seq):
+        """Capture time of the frame with this sequence number, or None if it is not known anymore."""
+        with self.condition:
+            for frame_seq, capture in self.capture_times:
+                if frame_seq == seq:
+                    return capture
+        return None
+
+    def valid(self, seq):
+        """Checks if the frame with this sequence number is still in the buffer, i.e. a view on it was not overwritten
+        while it was read."""
+        with self.condition:
+            return seq in self.seqs and self.seq - seq < len(self.slots) - 1
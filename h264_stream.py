@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+H.264 streaming to browsers over a websocket.
+
+The camera's hardware encoder records H.264 on a third splitter port into an H264Output, which hands every chunk of
+the stream to the asyncio server. The server sends the chunks as binary websocket messages to the viewers of
+/h264.html, which play them with a small JavaScript muxer (JMuxer) in a <video> element. The detections of every
+frame are sent on the same websocket as JSON text messages and drawn onto a canvas over the video, so the Pi neither
+draws nor JPEG encodes frames for these viewers.
+"""
+
+import base64
+import hashlib
+import json
+import struct
+from threading import Lock
+
+import overlay
+from vision import BORDER
+
+# Types of the NAL units that a chunk of the stream starts with
+NAL_SPS = 7  # Sequence parameter set, which the encoder repeats before every key frame (inline_headers=True)
+
+_WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+
+
+class H264Output(object):
+    """Output object where the camera writes its H.264 stream into, which is fanned out to the websocket viewers."""
+
+    def __init__(self):
+        self.listeners = []  # Callbacks that get every chunk of the stream, e.g. by the asyncio server
+        self.request_key_frame = None  # Optional function that makes the encoder send a key frame soon
+        self.lock = Lock()
+
+    def add_listener(self, callback):
+        with self.lock:
+            self.listeners.append(callback)
+
+    def write(self, buf):
+        # A chunk that starts with the stream headers is the start of a key frame, new viewers can start there
+        data = bytes(buf)
+        key_frame = len(data) > 4 and data[:4] == b'\x00\x00\x00\x01' and data[4] & 0x1F == NAL_SPS
+        with self.lock:
+            listeners = list(self.listeners)
+        for callback in listeners:
+            callback(data, key_frame)
+        return len(buf)
+
+    def flush(self):
+        pass
+
+
+###############
+## WEBSOCKET
+###############
+
+def websocket_accept(key):
+    """Value of the Sec-WebSocket-Accept header of the handshake response."""
+    return base64.b64encode(hashlib.sha1((key + _WEBSOCKET_GUID).encode('latin-1')).digest()).decode('latin-1')
+
+
+def websocket_frame(payload, opcode=OPCODE_BINARY):
+    """Frames one unmasked server message."""
+    n = len(payload)
+    if n < 126:
+        header = struct.pack('!BB', 0x80 | opcode, n)
+    elif n < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+    return header + payload
+
+
+async def read_websocket_frame(reader):
+    """Reads one (masked) client message and returns (opcode, payload)."""
+    first, second = await reader.readexactly(2)
+    n = second & 0x7F
+    if n == 126:
+        n, = struct.unpack('!H', await reader.readexactly(2))
+    elif n == 127:
+        n, = struct.unpack('!Q', await reader.readexactly(8))
+    mask = await reader.readexactly(4) if second & 0x80 else b'\x00' * 4
+    payload = bytearray(await reader.readexactly(n))
+    for i in range(n):
+        payload[i] ^= mask[i % 4]
+    return first & 0x0F, bytes(payload)
+
+
+###############
+## VIEWER PAGE
+###############
+
+H264_PAGE = """\
+<html>
+<head>
+<title>picamera H.264 streaming demo</title>
+<script src="https://unpkg.com/jmuxer@2.0.5/dist/jmuxer.min.js"></script>
+<style>
+#view { position: relative; width: 640px; height: 480px; }
+#view video, #view canvas { position: absolute; left: 0; top: 0; width: 640px; height: 480px; }
+</style>
+</head>
+<body>
+<div id="view"><video id="video" autoplay muted playsinline></video><canvas id="overlay"></canvas></div>
+<script>
+var EDGES = @EDGES@;
+var MIN_SCORE = @MIN_SCORE@;
+var BORDER = @BORDER@;
+var jmuxer = new JMuxer({node: 'video', mode: 'video', flushingTime: 0, fps: @FPS@});
+var canvas = document.getElementById('overlay');
+var ctx = canvas.getContext('2d');
+
+function rgb(bgr) { return 'rgb(' + bgr[2] + ',' + bgr[1] + ',' + bgr[0] + ')'; }
+
+// Draws the detections of one frame like overlay.py does on the MJPEG stream
+function draw(frame) {
+  canvas.width = frame.width;
+  canvas.height = frame.height;
+  ctx.lineWidth = BORDER;
+  frame.faces.forEach(function (rect, i) {
+    ctx.strokeStyle = rgb(frame.colors[i]);
+    ctx.strokeRect(rect[0], rect[1], rect[2], rect[3]);
+  });
+  if (!frame.pose) { return; }
+  var points = frame.pose.map(function (k) { return [k[1] * frame.width, k[0] * frame.height, k[2]]; });
+  ctx.lineWidth = Math.round(BORDER * 0.75);
+  EDGES.forEach(function (edge) {
+    var a = points[edge[0]], b = points[edge[1]];
+    if (a[2] >= MIN_SCORE && b[2] >= MIN_SCORE) {
+      ctx.strokeStyle = rgb(edge[2]);
+      ctx.beginPath(); ctx.moveTo(a[0], a[1]); ctx.lineTo(b[0], b[1]); ctx.stroke();
+    }
+  });
+  ctx.fillStyle = 'rgb(255,255,0)';
+  points.forEach(function (p) {
+    if (p[2] >= MIN_SCORE) { ctx.beginPath(); ctx.arc(p[0], p[1], BORDER, 0, 2 * Math.PI); ctx.fill(); }
+  });
+}
+
+var ws = new WebSocket('ws://' + location.host + '/stream.h264');
+ws.binaryType = 'arraybuffer';
+ws.onmessage = function (event) {
+  if (typeof event.data === 'string') {
+    draw(JSON.parse(event.data));
+  } else {
+    jmuxer.feed({video: new Uint8Array(event.data)});
+  }
+};
+</script>
+</body>
+</html>
+"""
+
+
+def h264_page(fps):
+    """The viewer page, with the skeleton and the drawing settings of overlay.py."""
+    return (H264_PAGE.replace('@EDGES@', json.dumps(overlay.skeleton())).replace('@MIN_SCORE@', str(overlay.MIN_SCORE))
+            .replace('@BORDER@', str(BORDER)).replace('@FPS@', str(fps)))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Inference service that owns the Edge TPU interpreters.
+
+The processing stages don't invoke the models themselves, they submit requests: the input is prepared (cropped and
+resized) right away in the calling thread, queued, and the result arrives later as a concurrent.futures.Future. One
+background thread takes all queued requests, runs those of the same model back to back and hands the outputs back. So
+while the TPU runs MoveNet on a frame, the CPU already detects the faces and prepares their crops, and the TPU gets
+the next requests as soon as it is done, instead of waiting for the CPU stages in between.
+
+Face recognition and pose detection share the Edge TPU. If both models are compiled together
+(edgetpu_compiler face.tflite movenet.tflite), their parameters fit into the TPU's memory at the same time and
+switching between the models does not upload them again; models.load_interpreter creates all interpreters on the same
+Edge TPU for this.
+
+    service = InferenceService({'face': face_interpreter, 'pose': pose_interpreter})
+    service.start()
+    pose = service.submit('pose', frame)
+    ...
+    keypoints = vision.pose_keypoints(pose.result())
+
+A service that was not started runs every request right away in the calling thread, like the stages did before.
+"""
+
+import logging
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Thread
+
+import cv2
+
+import models
+import vision
+
+
+class InferenceService(Thread):
+    """Runs the requests of all processing stages on the Edge TPU, one after the other in a background thread."""
+
+    def __init__(self, interpreters, max_queue=32, metrics=None):
+        super().__init__(daemon=True)
+        self.interpreters = dict(interpreters)  # Name -> interpreter or models.LazyModel
+        self.queue = Queue(maxsize=max_queue)  # Submitting blocks when the TPU is this far behind
+        self.metrics = metrics  # Optional Metrics that get the waiting time and the invoke time of every request
+
+    def ready(self, name):
+        """Returns the interpreter if the model can be used right away. Otherwise starts loading it in the background
+        and returns None, see models.ready()."""
+        return models.ready(self.interpreters.get(name))
+
+    def submit(self, name, image):
+        """Resizes the image to the input size of the model (in the calling thread) and queues it. Returns a Future
+        with a copy of the first output tensor. The model must be ready."""
+        interpreter = self.ready(name)
+        if interpreter is None:
+            raise ValueError('Model %s is not loaded' % name)
+        request = (name, interpreter, cv2.resize(image, vision.model_helpers().input_size(interpreter)), Future(),
+                   time.perf_counter())
+        if self.is_alive():
+            self.queue.put(request)
+        else:
+            self._invoke(*request)
+        return request[3]
+
+    def stop(self):
+        """Runs the queued requests and ends the thread."""
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+    def run(self):
+        running = True
+        while running:
+            requests = [self.queue.get()]
+            # Everything that queued up while the TPU was busy is run as one batch, grouped by model in the order in
+            # which the models were first requested, so the TPU switches models as rarely as possible
+            while True:
+                try:
+                    requests.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if None in requests:
+                running = False
+                requests = [request for request in requests if request is not None]
+            order = {}
+            for request in requests:
+                order.setdefault(request[0], len(order))
+            requests.sort(key=lambda request: order[request[0]])
+            for request in requests:
+                self._invoke(*request)
+
+    def _invoke(self, name, interpreter, data, future, submitted):
+        if not future.set_running_or_notify_cancel():
+            return
+        common = vision.model_helpers()
+        start = time.perf_counter()
+        try:
+            common.set_input(interpreter, data)
+            interpreter.invoke()
+            output = common.output_tensor(interpreter, 0).copy()
+        except Exception as e:
+            logging.warning('Could not run %s: %s', name, str(e))
+            future.set_exception(e)
+            return
+        future.set_result(output)
+        if self.metrics is not None:
+            self.metrics.observe('tpu_queue', start - submitted)
+            self.metrics.observe('tpu_%s' % name, time.perf_counter() - start)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End-to-end latency tracing of the camera frames.
+
+The camera outputs remember when each frame was captured: with a camera_clock, from the timestamp that the camera
+gives every frame, otherwise from the time the frame arrived. The processing starts a trace for every frame it takes,
+every stage adds a time stamp to it, and at the end (frame published to the stream, or command sent to the motors)
+the tracer records the age of the frame in the Metrics:
+
+    queue_delay         capture -> start of the processing (time spent waiting in buffers)
+    glass_to_glass      capture -> annotated frame published to the streaming clients
+    glass_to_actuator   capture -> motor command written to the serial port
+
+Optionally every trace is also written as one line of JSON to a trace file for offline analysis, with the time of
+every stage in ms after the capture.
+"""
+
+import json
+import logging
+import time
+from threading import Lock
+
+
+def camera_clock(camera, splitter_port=None):
+    """Returns a function that gives the capture time of the frame that the camera currently delivers, on the
+    time.monotonic() clock. Set it as .clock of the FrameBuffer/YUVOutput that records the frames.
+
+    Without splitter_port, the public camera.frame is used, which is the frame of the main recording. picamera has
+    no public frame information of the other splitter ports, for them the encoder of the port is asked; if that is
+    not possible (e.g. with another picamera version), the time the frame arrived is used and a warning is logged once.
+
+    The camera must be opened with clock_mode='raw': only then are the frame timestamps on the same clock as
+    camera.timestamp (with the default 'reset', they count from the start of the recording)."""
+    warned = []
+
+    def frame(now):
+        if splitter_port is None:
+            return camera.frame
+        encoder = getattr(camera, '_encoders', {}).get(splitter_port)
+        if encoder is None or not hasattr(encoder, 'frame'):
+            if not warned:
+                warned.append(now)
+                logging.warning('No frame information of splitter port %i, using the arrival time of its frames',
+                                splitter_port)
+            return None
+        return encoder.frame
+
+    def capture_time():
+        now = time.monotonic()
+        try:
+            info = frame(now)
+            if info is None or info.timestamp is None:
+                return now
+            # Both camera times are in us on the clock of the GPU, their difference is the age of the frame
+            return now - (camera.timestamp - info.timestamp) / 1e6
+        except Exception:
+            return now  # Frame information is not available, e.g. because the camera is not recording
+    return capture_time
+
+
+def mark(trace, stage):
+    """Adds a time stamp for the end of a stage to the trace of a frame (trace None -> tracing is off)."""
+    if trace is not None:
+        trace['marks'].append((stage, time.monotonic()))
+
+
+class LatencyTracer(object):
+    """Starts and finishes the traces of the frames and collects the latencies."""
+
+    def __init__(self, metrics=None, trace_file=None):
+        self.metrics = metrics  # Optional Metrics that get the latency distributions
+        self.file = open(trace_file, 'a') if trace_file is not None else None
+        self.lock = Lock()
+
+    def begin(self, seq, capture):
+        """Starts the trace of the frame with this sequence number and capture time, when its processing starts."""
+        trace = {'seq': seq, 'capture': capture, 'marks': []}
+        mark(trace, 'start')
+        return trace
+
+    def finish(self, trace, end):
+        """Ends the trace with the final stage, e.g. 'glass_to_glass' or 'glass_to_actuator'."""
+        if trace is None:
+            return
+        mark(trace, end)
+        capture = trace['capture']
+        if capture is None:
+            return  # The frame did not come from a camera output
+        if self.metrics is not None:
+            self.metrics.observe('queue_delay', trace['marks'][0][1] - capture)
+            self.metrics.observe(end, trace['marks'][-1][1] - capture)
+        if self.file is not None:
+            record = {'seq': trace['seq'], 'capture': capture}
+            record.update((stage, round((t - capture) * 1000, 3)) for stage, t in trace['marks'])
+            with self.lock:
+                if self.file is not None:
+                    self.file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.file is not None:
+            with self.lock:
+                self.file.close()
+                self.file = None
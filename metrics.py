@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Low-overhead performance metrics of the camera stream.
+
+Every processing stage records its duration into a rolling window, from which percentiles are computed only when the
+metrics are requested. Besides the stage timings, the achieved frame rate, counters (e.g. dropped frames, TPU
+invokes) and gauges (e.g. connected clients) are collected. The streaming server exposes everything on /metrics in
+the Prometheus text format and on /metrics.json as JSON.
+"""
+
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _quantile(values, q):
+    """Quantile of an already sorted list, without interpolation."""
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Metrics(object):
+    """Thread-safe collection of stage timings, counters and gauges."""
+
+    def __init__(self, window=240, prefix='enb'):
+        self.window = window  # Number of recent samples that the percentiles and the frame rate are computed from
+        self.prefix = prefix  # Prefix of all metric names in the Prometheus format
+        self.lock = Lock()
+
+        self.timings = {}  # Stage -> recent durations [s]
+        self.totals = {}  # Stage -> [number of samples, total duration [s]] since the start
+        self.counters = {}
+        self.gauges = {}
+        self.frame_times = deque(maxlen=window)  # Time stamps of the recently published frames
+
+    @contextmanager
+    def time(self, stage):
+        """Context manager that records the duration of its block as one sample of the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.timings:
+                self.timings[stage] = deque(maxlen=self.window)
+                self.totals[stage] = [0, 0.0]
+            self.timings[stage].append(seconds)
+            self.totals[stage][0] += 1
+            self.totals[stage][1] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def inc_gauge(self, name, delta=1):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def frame_published(self):
+        """Call once per published frame, the frame rate is computed from these calls."""
+        now = time.monotonic()
+        with self.lock:
+            self.frame_times.append(now)
+            self.counters['frames'] = self.counters.get('frames', 0) + 1
+
+    def snapshot(self):
+        """Returns all metrics as dictionary."""
+        with self.lock:
+            timings = {stage: sorted(values) for stage, values in self.timings.items()}
+            totals = {stage: tuple(total) for stage, total in self.totals.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            frame_times = list(self.frame_times)
+
+        fps = 0.0
+        if len(frame_times) > 1 and frame_times[-1] > frame_times[0]:
+            fps = (len(frame_times) - 1) / (frame_times[-1] - frame_times[0])
+
+        stages = {}
+        for stage, values in timings.items():
+            stages[stage] = {'count': totals[stage][0],
+                             'sum': totals[stage][1],
+                             'mean': sum(values) / len(values),
+                             'max': values[-1]}
+            for q in QUANTILES:
+                stages[stage]['p%g' % (q * 100)] = _quantile(values, q)
+        return {'fps': fps, 'stages': stages, 'counters': counters, 'gauges': gauges}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        p = self.prefix
+        lines = ['# TYPE %s_fps gauge' % p, '%s_fps %f' % (p, snapshot['fps'])]
+
+        lines.append('# TYPE %s_stage_seconds summary' % p)
+        for stage, stats in sorted(snapshot['stages'].items()):
+            for q in QUANTILES:
+                lines.append('%s_stage_seconds{stage="%s",quantile="%g"} %f' % (p, stage, q, stats['p%g' % (q * 100)]))
+            lines.append('%s_stage_seconds_sum{stage="%s"} %f' % (p, stage, stats['sum']))
+            lines.append('%s_stage_seconds_count{stage="%s"} %i' % (p, stage, stats['count']))
+
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE %s_%s_total counter' % (p, name))
+            lines.append('%s_%s_total %i' % (p, name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('# TYPE %s_%s gauge' % (p, name))
+            lines.append('%s_%s %g' % (p, name, value))
+        return '\n'.join(lines) + '\n'
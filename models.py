@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Loading of the Coral models.
+
+Creating an Edge TPU interpreter and its first invoke (which uploads the model to the accelerator) take a noticeable
+time. LazyModel does this in a background thread, so the stream already runs while the models are still loading; the
+processing stages simply skip a model until it is ready. Models of disabled stages are never loaded at all.
+
+All interpreters of a process share one Edge TPU delegate, so models that were compiled together
+(edgetpu_compiler face.tflite movenet.tflite) keep their parameters cached on the TPU side by side.
+"""
+
+import logging
+import time
+from threading import Lock, Thread
+
+_delegates = {}  # Edge TPU delegate of every device, shared by all interpreters on it
+_delegates_lock = Lock()
+
+
+def edgetpu_delegate(device=None):
+    """Returns the delegate of an Edge TPU (e.g. ':0' or 'usb'), opened on first use."""
+    from pycoral.utils.edgetpu import load_edgetpu_delegate
+
+    with _delegates_lock:
+        if device not in _delegates:
+            _delegates[device] = load_edgetpu_delegate({'device': device} if device else None)
+        return _delegates[device]
+
+
+def load_interpreter(model_file, device=None):
+    """Creates an Edge TPU interpreter and warms it up with one invoke on an empty input."""
+    # Imported here, so scripts that don't use the Edge TPU also run without pycoral
+    from pycoral.utils.edgetpu import make_interpreter
+
+    interpreter = make_interpreter(model_file, delegate=edgetpu_delegate(device))
+    interpreter.allocate_tensors()
+    interpreter.invoke()  # The first invoke is slow, better pay it before the first frame
+    return interpreter
+
+
+class LazyModel(object):
+    """Model that is only loaded on first use, or in the background after start() was called."""
+
+    def __init__(self, loader, *args, name=None):
+        self.loader = loader  # Function that loads and returns the model, called with args
+        self.args = args
+        self.name = name if name is not None else str(args[0] if args else loader)
+        self.model = None
+        self.lock = Lock()
+        self.thread = None  # Background thread that loads the model
+
+    def start(self):
+        """Starts loading the model in a background thread (once) and returns right away."""
+        if self.thread is None:
+            self.thread = Thread(target=self._load, daemon=True)
+            self.thread.start()
+        return self
+
+    @property
+    def ready(self):
+        return self.model is not None
+
+    def get(self):
+        """Returns the model, loads it first if necessary."""
+        if self.model is not None:
+            return self.model
+        with self.lock:
+            if self.model is None:
+                start = time.perf_counter()
+                self.model = self.loader(*self.args)
+                logging.info('Loaded %s in %.2f s', self.name, time.perf_counter() - start)
+            return self.model
+
+    def _load(self):
+        try:
+            self.get()
+        except Exception as e:
+            # The stage that needs the model stays disabled, the stream keeps running
+            logging.error('Could not load %s: %s', self.name, str(e))
+
+
+def ready(model):
+    """Returns the model if it can be used right away (passed directly or finished loading). Otherwise starts loading
+    it in the background and returns None."""
+    if isinstance(model, LazyModel):
+        if not model.ready:
+            model.start()
+        return model.model
+    return model
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Drawing of the detections onto the streamed frames.
+
+All keypoints are converted to pixel coordinates in one NumPy operation, and the index arrays and colors of the
+skeleton are prepared once at import. The drawing itself is batched: one cv2.polylines call per color draws all bones
+(or face boxes) of that color, and all keypoints are drawn in one call as zero-length lines, whose round caps are
+filled dots. Bones and keypoints with a low score are not drawn.
+
+For viewers of the H.264 stream, the detections are not drawn on the Pi but sent to the browser as JSON
+(detections_json), where the viewer page draws them with the same skeleton and colors (skeleton).
+"""
+
+import json
+
+import numpy as np
+import cv2
+
+from vision import BORDER, KEYPOINT_EDGE_INDS_TO_COLOR
+
+# Keypoints with a lower score are not drawn, neither are the bones that they are part of
+MIN_SCORE = 0.2
+
+KEYPOINT_COLOR = (0, 255, 255)  # Color of the keypoint dots
+KEYPOINT_RADIUS = BORDER
+BONE_THICKNESS = int(np.round(BORDER * 0.75))
+
+# Start and end keypoint of every bone, and the bones grouped by color: [(color, indices into _EDGES), ...]
+_EDGES = np.array(list(KEYPOINT_EDGE_INDS_TO_COLOR.keys()), dtype=np.intp)
+_EDGE_COLORS = list(KEYPOINT_EDGE_INDS_TO_COLOR.values())
+_EDGE_GROUPS = [(color, np.array([i for i, c in enumerate(_EDGE_COLORS) if c == color], dtype=np.intp))
+                for color in dict.fromkeys(_EDGE_COLORS)]
+
+# Corners of a box relative to its (x, y) in units of its (w, h)
+_BOX_CORNERS = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.int32)
+
+
+def keypoints_to_pixels(pose, width, height):
+    """Converts the relative (y, x) of all keypoints to integer (x, y) pixel coordinates at once."""
+    return (pose[:, 1::-1] * (width, height)).astype(np.int32)
+
+
+def draw_pose(frame, pose, min_score=MIN_SCORE):
+    """Draws the bones and keypoints of a detected pose onto the frame."""
+    height, width = frame.shape[:2]
+    points = keypoints_to_pixels(pose, width, height)
+    visible = pose[:, 2] >= min_score
+
+    # Draw the bones (lines between certain keypoints) whose both ends were found, one call per color
+    bones = points[_EDGES]  # (n_bones, 2, 2)
+    bone_visible = visible[_EDGES].all(axis=1)
+    for color, group in _EDGE_GROUPS:
+        lines = bones[group[bone_visible[group]]]
+        if len(lines):
+            cv2.polylines(frame, list(lines), False, color, BONE_THICKNESS)
+
+    # Draw the keypoints as cyan dots: a line from a point to itself is a filled circle
+    dots = points[visible].reshape(-1, 1, 2).repeat(2, axis=1)
+    if len(dots):
+        cv2.polylines(frame, list(dots), False, KEYPOINT_COLOR, 2 * KEYPOINT_RADIUS)
+
+
+def draw_faces(frame, rects, colors, face_count):
+    """Draws a rectangle around every detected face and the face counter (if not None) onto the frame."""
+    if len(rects):
+        # Corners of all rectangles at once: (n, 4, 2)
+        rects = np.asarray(rects, dtype=np.int32).reshape(-1, 1, 4)
+        corners = rects[:, :, :2] + rects[:, :, 2:] * _BOX_CORNERS
+
+        # One call per color (usually just recognised and unknown)
+        colors = [tuple(color) for color in colors]
+        for color in set(colors):
+            cv2.polylines(frame, [box for box, c in zip(corners, colors) if c == color], True, color, BORDER)
+
+    # Put face counter on top of the streamed frame (only while faces are saved)
+    if face_count is not None:
+        cv2.putText(frame, "%i" % face_count, (100, 100), cv2.FONT_HERSHEY_SIMPLEX, 2, 255)
+
+
+def skeleton():
+    """Bones of the pose as [start keypoint, end keypoint, BGR color], e.g. for the H.264 viewer page."""
+    return [[int(a), int(b), list(color)] for (a, b), color in zip(_EDGES, _EDGE_COLORS)]
+
+
+def detections_json(shape, rects, colors, pose):
+    """The detections of one frame as JSON, to be drawn by the client instead of onto the frame: face rectangles
+    (x, y, w, h) in pixels of a frame with this shape, their BGR colors and the keypoints (y, x, score)."""
+    return json.dumps({
+        'width': shape[1], 'height': shape[0],
+        'faces': [[int(v) for v in rect] for rect in rects],
+        'colors': [[int(c) for c in color] for color in colors],
+        'pose': np.round(pose.astype(float), 3).tolist() if pose is not None else None,
+    })
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Multi-process version of the frame processing in cameraStream.py.
+
+Decoding, face detection, Coral inference and drawing/encoding each run in their own worker process, so the stages
+overlap on the different cores of the Pi. Decoded frames are never pickled: they live in a ring of shared memory
+slots, and only the slot index and the (small) detection results are sent from one stage to the next. Raw YUV frames
+need no decoding, they are converted straight into the ring by the feeder thread.
+"""
+
+import time
+import multiprocessing as mp
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from queue import Empty, Full
+from threading import Thread
+
+import numpy as np
+import cv2
+
+import vision
+import overlay
+import latency
+from models import LazyModel, load_interpreter, ready
+from tracking import FaceTracker, RecognitionCache
+from face_writer import FaceWriter
+from face_store import FaceStore
+from scheduler import StageScheduler
+from pose_tracking import PoseTracker
+from pose_recorder import PoseRecorder
+from inference import InferenceService
+
+# Worker processes are forked, so they inherit the shared memory ring and never re-import the streaming script
+_CTX = mp.get_context('fork')
+
+
+def _new_stats():
+    """Per-frame statistics that travel with the frame through the stages and end up in the Metrics. The optional
+    latency trace collects a time stamp from every worker (time.monotonic is the same clock in all processes)."""
+    return {'start': time.perf_counter(), 'timings': {}, 'counts': {}, 'trace': None}
+
+
+# Stages that run one after the other in the same worker process
+_WORKER_STAGES = (('decode_analysis', 'decode'), ('detect', 'save'), ('recognise', 'pose'), ('draw', 'encode'))
+
+
+def _bottleneck(timings):
+    """Time that the slowest worker spent on a frame, which limits the frame rate of the whole pipeline."""
+    return max(sum(timings.get(stage, 0) for stage in group) for group in _WORKER_STAGES)
+
+
+@contextmanager
+def _timed(stats, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats['timings'][stage] = stats['timings'].get(stage, 0) + time.perf_counter() - start
+
+
+class SharedFrameRing(object):
+    """Fixed number of frame slots in shared memory.
+
+    Each slot holds the streamed BGR frame and the greyscale frame for face detection. In dual-resolution mode, a slot
+    additionally holds the small BGR analysis frame, and the greyscale frame has the size of the analysis frame.
+    """
+
+    def __init__(self, shape, n_slots=4, analysis_shape=None):
+        self.shape = tuple(shape)  # (height, width, channels) of the streamed BGR frames
+        self.analysis_shape = tuple(analysis_shape) if analysis_shape is not None else None
+        self.n_slots = n_slots
+
+        self.frame_bytes = int(np.prod(self.shape))
+        self.analysis_bytes = int(np.prod(self.analysis_shape)) if self.analysis_shape is not None else 0
+        gray_shape = (self.analysis_shape or self.shape)[:2]
+        self.gray_shape = gray_shape
+        self.slot_bytes = self.frame_bytes + self.analysis_bytes + gray_shape[0] * gray_shape[1]
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slot_bytes * n_slots)
+
+        # (x, y) factors between streamed and analysed frame, to map detections back to the streamed frame
+        self.scale = vision.frame_scale(self.shape, self.gray_shape)
+
+    def frame(self, slot):
+        """Returns the BGR frame of a slot as numpy array that points directly into the shared memory."""
+        offset = slot * self.slot_bytes
+        return np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+
+    def analysis(self, slot):
+        """Returns the BGR frame that detection and inference run on (the streamed frame if not in dual mode)."""
+        if self.analysis_shape is None:
+            return self.frame(slot)
+        offset = slot * self.slot_bytes + self.frame_bytes
+        return np.ndarray(self.analysis_shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+
+    def gray(self, slot):
+        """Returns the greyscale frame of a slot as numpy array that points directly into the shared memory."""
+        offset = slot * self.slot_bytes + self.frame_bytes + self.analysis_bytes
+        return np.ndarray(self.gray_shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _decode_worker(ring, in_q, out_q):
+    """Decodes incoming JPEG frames into the ring slot that the feeder reserved for them."""
+    while True:
+        msg = in_q.get()
+        if msg is None:
+            out_q.put(None)
+            break
+        seq, slot, jpeg, stats = msg
+
+        with _timed(stats, 'decode'):
+            frame = ring.frame(slot)
+            frame[:] = vision.decode_frame(jpeg)
+            if ring.analysis_shape is None:
+                cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=ring.gray(slot))
+        latency.mark(stats['trace'], 'decode')
+        out_q.put((seq, slot, stats))
+
+
+def _detect_worker(ring, cascade_file, detect_interval, min_face_size, stages, face_store, face_label, in_q, out_q):
+    """Runs the Haar cascade/face tracker on the greyscale frame and optionally saves the detected faces."""
+    # Stages can be switched on at runtime, so the detector and the face writer are only created on first use
+    det = LazyModel(cv2.CascadeClassifier, cascade_file)
+    if stages['detect_faces']:
+        det.start()
+    tracker = FaceTracker(None, detect_interval=detect_interval, min_size=(min_face_size, min_face_size))
+    saver = None
+    tracks = []  # Last found faces, reused on frames on which the scheduler skips the detection
+    live_ids = set()  # Tracks that the tracker still follows, the inference worker keeps their recognition results
+
+    while True:
+        msg = in_q.get()
+        if msg is None:
+            if saver is not None:
+                saver.stop()
+            out_q.put(None)
+            break
+        seq, slot, stats = msg
+        enabled, due = stats['enabled'], stats['due']
+
+        if not enabled['detect_faces']:
+            tracks = []
+            live_ids = set()
+        elif due['detect_faces'] and ready(det) is not None:
+            tracker.det = det.model
+            with _timed(stats, 'detect'):
+                tracks = [(track.id, track.rect) for track in tracker.update(ring.gray(slot))]
+            live_ids = tracker.live_ids()
+            if enabled['save_faces'] and tracks:
+                if saver is None:
+                    saver = FaceWriter(store=FaceStore(face_store) if face_store is not None else None,
+                                       label=face_label)
+                    saver.start()
+                with _timed(stats, 'save'):
+                    saver.submit(ring.frame(slot), vision.scale_rects([rect for _, rect in tracks], ring.scale))
+        face_count = saver.face_i - 1 if saver is not None else None
+        latency.mark(stats['trace'], 'detect')
+        out_q.put((seq, slot, tracks, live_ids, face_count, stats))
+
+
+def _inference_worker(ring, face_model, pose_model, stages, pose_log, in_q, out_q):
+    """Owns the Edge TPU and runs face recognition and pose detection."""
+    # The interpreters are created inside the worker, so only this process ever talks to the TPU. They load (and warm
+    # up) in the background, until then frames pass through without recognition/pose. Models of disabled stages are
+    # only loaded when the stage is switched on.
+    face_interpreter = LazyModel(load_interpreter, face_model)
+    if stages['detect_faces'] and stages['recognise_faces']:
+        face_interpreter.start()
+    pose_interpreter = LazyModel(load_interpreter, pose_model)
+    if stages['detect_poses']:
+        pose_interpreter.start()
+    # The TPU runs the pose of a frame while this worker crops and prepares its faces
+    inference = InferenceService({'face': face_interpreter, 'pose': pose_interpreter})
+    inference.start()
+    recognition_cache = RecognitionCache()
+    pose_tracker = PoseTracker()  # Smooths the pose, and predicts it on frames on which the pose detection is skipped
+    recorder = None
+    if pose_log is not None:
+        recorder = PoseRecorder(pose_log)
+        recorder.start()
+
+    while True:
+        msg = in_q.get()
+        if msg is None:
+            inference.stop()
+            if recorder is not None:
+                recorder.stop()
+            out_q.put(None)
+            break
+        seq, slot, tracks, live_ids, face_count, stats = msg
+        enabled, due = stats['enabled'], stats['due']
+        frame = ring.analysis(slot)
+        # Face positions in the coordinates of the streamed frame
+        rects = vision.scale_rects([rect for _, rect in tracks], ring.scale)
+
+        pose_request = None
+        if not enabled['detect_poses']:
+            pose = None
+            pose_tracker.reset()
+        elif due['detect_poses'] and inference.ready('pose') is not None:
+            with _timed(stats, 'pose'):
+                crop, region = pose_tracker.crop(frame)
+                pose_request = (inference.submit('pose', crop), region)
+        else:
+            pose = pose_tracker.predict(stats['start'])
+
+        recognised = None
+        recognising = enabled['detect_faces'] and enabled['recognise_faces'] and inference.ready('face') is not None
+        if recognising and due['recognise_faces']:
+            invokes = recognition_cache.invokes
+            with _timed(stats, 'recognise'):
+                recognised = recognition_cache.submit(inference, frame, tracks, live_ids)
+
+        # Collect the results in the order in which the TPU runs them
+        if pose_request is not None:
+            with _timed(stats, 'pose'):
+                future, region = pose_request
+                pose = pose_tracker.add(vision.pose_keypoints(future.result()), region, frame.shape, stats['start'])
+            stats['counts']['pose_invokes'] = 1
+        if recognised is not None:
+            with _timed(stats, 'recognise'):
+                colors = recognised()
+            stats['counts']['face_invokes'] = recognition_cache.invokes - invokes
+        elif recognising:
+            colors = recognition_cache.cached(tracks, live_ids)
+        else:
+            # If no face recognition, all rectangles should be green
+            colors = [(0, 255, 0)] * len(rects)
+        if recorder is not None and pose is not None:
+            recorder.record(time.time(), pose, 'pose_invokes' in stats['counts'])
+        latency.mark(stats['trace'], 'inference')
+        out_q.put((seq, slot, rects, colors, face_count, pose, stats))
+
+
+def _encode_worker(ring, in_q, free_q, out_q):
+    """Draws all detections onto the frame, encodes it to JPEG and hands the slot back to the feeder. The detections
+    are also sent on as JSON for the H.264 viewers, and frames that nobody watches as MJPEG are not encoded."""
+    while True:
+        msg = in_q.get()
+        if msg is None:
+            out_q.put(None)
+            break
+        seq, slot, rects, colors, face_count, pose, stats = msg
+        frame = ring.frame(slot)
+
+        detections = overlay.detections_json(frame.shape, rects, colors, pose) if stats['overlay'] else None
+        jpeg = None
+        if stats['encode']:
+            with _timed(stats, 'draw'):
+                if stats['enabled']['detect_faces']:
+                    overlay.draw_faces(frame, rects, colors, face_count)
+                if pose is not None:
+                    overlay.draw_pose(frame, pose)
+            with _timed(stats, 'encode'):
+                jpeg = vision.encode_frame(frame).tobytes()
+            latency.mark(stats['trace'], 'encode')
+
+        # The slot is not needed anymore, the feeder can fill it with the next frame
+        free_q.put(slot)
+        out_q.put((seq, jpeg, detections, stats))
+
+
+class ProcessPipeline(object):
+    """Drop-in replacement of the threaded FrameProcessor that spreads the processing stages over worker processes."""
+
+    def __init__(self, source, sink, shape, stages, cascade_file, face_model, pose_model, detect_interval=1,
+                 capture_mode='mjpeg', analysis=None, min_face_size=152, face_store=None, face_label=None,
+                 pose_log=None, scheduler=None, metrics=None, tracer=None, n_slots=4):
+        self.source = source  # FrameBuffer/YUVOutput where the camera writes the raw frames into
+        self.sink = sink  # AnnotatedOutput where the processed frames are published for the clients
+        self.capture_mode = capture_mode
+        self.analysis = analysis  # Optional YUVOutput with the small frames for detection and inference
+        self.metrics = metrics  # Optional Metrics that collect the stage timings of all workers
+        self.tracer = tracer  # Optional latency.LatencyTracer that follows every frame from capture to the stream
+        # Decides in the feeder which stages run on a frame; the decision travels with the frame to the workers
+        self.scheduler = scheduler if scheduler is not None else StageScheduler(stages)
+        analysis_shape = (analysis.height, analysis.width, 3) if analysis is not None else None
+        self.ring = SharedFrameRing(shape, n_slots, analysis_shape)
+
+        # Queues between the stages only carry slot indices and detection results, never whole frames
+        self.in_q = _CTX.Queue(maxsize=2)
+        self.free_q = _CTX.Queue()
+        for slot in range(n_slots):
+            self.free_q.put(slot)
+        self.decoded_q = _CTX.Queue()
+        detected_q = _CTX.Queue()
+        inferred_q = _CTX.Queue()
+        self.out_q = _CTX.Queue()
+
+        self.workers = [
+            _CTX.Process(target=_detect_worker,
+                         args=(self.ring, cascade_file, detect_interval, min_face_size, stages, face_store,
+                               face_label, self.decoded_q, detected_q),
+                         name='detect', daemon=True),
+            _CTX.Process(target=_inference_worker,
+                         args=(self.ring, face_model, pose_model, stages, pose_log, detected_q, inferred_q),
+                         name='inference', daemon=True),
+            _CTX.Process(target=_encode_worker, args=(self.ring, inferred_q, self.free_q, self.out_q),
+                         name='encode', daemon=True),
+        ]
+        if capture_mode == 'mjpeg':
+            # Raw frames are written into the ring by the feeder thread, only JPEG frames need a decoding stage
+            self.workers.insert(0, _CTX.Process(target=_decode_worker, args=(self.ring, self.in_q, self.decoded_q),
+                                                name='decode', daemon=True))
+        self.feeder = Thread(target=self._feed, daemon=True)
+        self.collector = Thread(target=self._collect, daemon=True)
+
+    def start(self):
+        # Fork the workers before any thread of this object runs
+        for worker in self.workers:
+            worker.start()
+        self.collector.start()
+        self.feeder.start()
+
+    def stop(self):
+        # The None sentinel travels through all stages and ends every worker after the frames in flight
+        if self.capture_mode == 'mjpeg':
+            self.in_q.put(None)
+        else:
+            self.decoded_q.put(None)
+        for worker in self.workers:
+            worker.join(timeout=2)
+            if worker.is_alive():
+                worker.terminate()
+        self.ring.close()
+
+    def _feed(self):
+        seq = 0
+        while True:
+            seq, last_frame, missed = self.source.wait(seq)
+            self._count('dropped_frames', missed)
+            stats = _new_stats()
+            if self.tracer is not None:
+                stats['trace'] = self.tracer.begin(seq, self.source.capture_time(seq))
+
+            # Reserve a slot for the new frame; if all slots are still busy in later stages, the frame is dropped
+            try:
+                slot = self.free_q.get_nowait()
+            except Empty:
+                self._count('dropped_frames')
+                continue
+            stats['enabled'], stats['due'] = self.scheduler.plan()
+            stats['encode'], stats['overlay'] = self.sink.wants_jpeg(), bool(self.sink.overlay_listeners)
+
+            if self.analysis is not None:
+                with _timed(stats, 'decode_analysis'):
+                    written = self._write_analysis(slot)
+                if not written:
+                    self.free_q.put(slot)  # The small stream did not deliver its first frame yet
+                    continue
+
+            if self.capture_mode == 'yuv':
+                with _timed(stats, 'decode'):
+                    self._write_raw(slot)
+                latency.mark(stats['trace'], 'decode')
+                self.decoded_q.put((seq, slot, stats))
+                continue
+            # The JPEG has to be copied out of the frame buffer to send it to the decoder
+            jpeg = bytes(last_frame)
+            if not self.source.valid(seq):
+                self.free_q.put(slot)  # The camera overwrote the frame while it was copied
+                self._count('dropped_frames')
+                continue
+            try:
+                self.in_q.put_nowait((seq, slot, jpeg, stats))
+            except Full:
+                self.free_q.put(slot)  # The decoder is busy, the frame is dropped
+                self._count('dropped_frames')
+
+    def _count(self, name, n=1):
+        if self.metrics is not None and n:
+            self.metrics.count(name, n)
+
+    def _write_raw(self, slot):
+        """Writes the latest raw frame straight into the ring slot, which replaces the decode worker."""
+        raw = self.source.acquire()
+        try:
+            self.ring.frame(slot)[:] = self.source.bgr(raw)
+            if self.analysis is None:
+                # The Y plane already is the greyscale image
+                self.ring.gray(slot)[:] = self.source.gray(raw)
+        finally:
+            self.source.release()
+
+    def _write_analysis(self, slot):
+        """Writes the latest small analysis frame into the ring slot. Returns False if there is no frame yet."""
+        raw = self.analysis.acquire()
+        try:
+            if raw is None:
+                return False
+            self.ring.analysis(slot)[:] = self.analysis.bgr(raw)
+            self.ring.gray(slot)[:] = self.analysis.gray(raw)
+        finally:
+            self.analysis.release()
+        return True
+
+    def _collect(self):
+        while True:
+            msg = self.out_q.get()
+            if msg is None:
+                break
+            _, jpeg, detections, stats = msg
+            if detections is not None:
+                self.sink.publish_overlay(detections)
+            if jpeg is not None:
+                self.sink.publish(jpeg)
+            if self.tracer is not None:
+                self.tracer.finish(stats['trace'], 'glass_to_glass')
+            self.scheduler.update(_bottleneck(stats['timings']))
+
+            if self.metrics is not None:
+                for stage, seconds in stats['timings'].items():
+                    self.metrics.observe(stage, seconds)
+                for name, n in stats['counts'].items():
+                    self._count(name, n)
+                self.metrics.observe('total', time.perf_counter() - stats['start'])
+                self.metrics.frame_published()
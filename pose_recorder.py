@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Recording of the detected poses into a compact binary log.
+
+The pose stage hands every pose with its time stamp to a bounded queue. A background thread appends them to chunks of
+preallocated, memory-mapped records (time, whether MoveNet ran on the frame or the pose was predicted, and the
+(17, 3) float32 keypoints), so long sessions can be recorded at full frame rate with a small, fixed amount of memory.
+The reader slices the log by time and exports poses in the layout of pose.csv (17 rows of y, x, score).
+
+    python pose_recorder.py info ../poses
+    python pose_recorder.py export ../poses session.csv --start 10 --end 20
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import time
+from threading import Thread
+
+import numpy as np
+
+INDEX_FILE = 'index.json'
+CHUNK_PATTERN = 'poses_%05i.npy'
+
+_NUM_KEYPOINTS = 17
+RECORD_DTYPE = np.dtype([('time', 'f8'), ('inferred', '?'), ('pose', 'f4', (_NUM_KEYPOINTS, 3))])
+
+
+class PoseLog(object):
+    """Chunked log of pose records. Open with mode 'a' to append poses or 'r' to read them."""
+
+    def __init__(self, directory, mode='r', chunk_size=65536):
+        self.directory = directory
+        self.mode = mode
+        self._chunks = {}  # Chunk number -> memory map
+
+        index_file = os.path.join(directory, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+            self.chunk_size = index['chunk_size']
+            self.count = index['count']
+        elif mode == 'r':
+            raise FileNotFoundError('No pose log in %s' % directory)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.chunk_size = chunk_size
+            self.count = 0
+            self.flush()
+
+    def __len__(self):
+        return self.count
+
+    def _chunk(self, n):
+        if n not in self._chunks:
+            fname = os.path.join(self.directory, CHUNK_PATTERN % n)
+            if os.path.exists(fname):
+                self._chunks[n] = np.lib.format.open_memmap(fname, mode='r' if self.mode == 'r' else 'r+')
+            else:
+                # Chunks are allocated at full size at once, the unused part of the file stays sparse
+                self._chunks[n] = np.lib.format.open_memmap(fname, mode='w+', dtype=RECORD_DTYPE,
+                                                            shape=(self.chunk_size,))
+        return self._chunks[n]
+
+    def append(self, t, pose, inferred=True):
+        chunk = self._chunk(self.count // self.chunk_size)
+        chunk[self.count % self.chunk_size] = (t, inferred, pose)
+        self.count += 1
+
+    def flush(self):
+        """Writes the records to disk and updates the index, afterwards readers see all appended poses."""
+        for chunk in self._chunks.values():
+            chunk.flush()
+        tmp_file = os.path.join(self.directory, INDEX_FILE + '.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump({'chunk_size': self.chunk_size, 'count': self.count}, f)
+        os.replace(tmp_file, os.path.join(self.directory, INDEX_FILE))
+
+    def start_time(self):
+        """Time of the first pose, or None if the log is empty."""
+        return float(self._chunk(0)['time'][0]) if self.count else None
+
+    def records(self):
+        """Yields the records of every chunk as views on the memory maps."""
+        for start in range(0, self.count, self.chunk_size):
+            yield self._chunk(start // self.chunk_size)[:min(self.chunk_size, self.count - start)]
+
+    def slice(self, start=None, end=None):
+        """Returns the records with start <= time < end (None -> no limit) as one array. The times are sorted, so
+        only the chunks in the range are read."""
+        parts = []
+        for records in self.records():
+            if len(records) == 0 or (end is not None and records['time'][0] >= end) or \
+                    (start is not None and records['time'][-1] < start):
+                continue
+            i0 = np.searchsorted(records['time'], start, 'left') if start is not None else 0
+            i1 = np.searchsorted(records['time'], end, 'left') if end is not None else len(records)
+            parts.append(records[i0:i1])
+        return np.concatenate(parts) if parts else np.empty(0, dtype=RECORD_DTYPE)
+
+    def export_csv(self, fname, start=None, end=None, inferred_only=False):
+        """Writes the poses in a time range in the layout of pose.csv: 17 rows of (y, x, score) per pose, each pose
+        after a comment line with its time (np.loadtxt(fname).reshape(-1, 17, 3) reads them back)."""
+        records = self.slice(start, end)
+        if inferred_only:
+            records = records[records['inferred']]
+        with open(fname, 'w') as f:
+            for record in records:
+                if len(records) > 1:
+                    f.write('# time %.6f%s\n' % (record['time'], '' if record['inferred'] else ' predicted'))
+                np.savetxt(f, record['pose'])
+        return len(records)
+
+
+class PoseRecorder(Thread):
+    """Appends poses to a PoseLog in a background thread, so recording never blocks the stream."""
+
+    def __init__(self, directory, chunk_size=65536, max_queue=256, flush_interval=1.0, metrics=None):
+        super().__init__(daemon=True)
+        self.log = PoseLog(directory, mode='a', chunk_size=chunk_size)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.flush_interval = flush_interval  # Maximum time [s] until recorded poses are visible to readers
+        self.metrics = metrics  # Optional Metrics that count recorded and dropped poses
+
+    def record(self, t, pose, inferred=True):
+        """Hands a pose over to the recorder, or drops it if the recorder fell behind."""
+        try:
+            self.queue.put_nowait((t, pose.copy(), inferred))
+        except queue.Full:
+            if self.metrics is not None:
+                self.metrics.count('dropped_poses')
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        last_flush = time.monotonic()
+        dirty = False  # Whether there are poses that readers can't see yet
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            try:
+                if item:
+                    self.log.append(*item)
+                    dirty = True
+                    if self.metrics is not None:
+                        self.metrics.count('recorded_poses')
+                # Make the new poses visible to readers at most once per flush interval instead of for every pose
+                if dirty and time.monotonic() - last_flush >= self.flush_interval:
+                    self.log.flush()
+                    last_flush, dirty = time.monotonic(), False
+            except Exception as e:
+                logging.warning('Could not record poses: %s', str(e))
+        self.log.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tools for recorded pose logs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    info_parser = subparsers.add_parser('info', help='Print the length and duration of a log')
+    info_parser.add_argument('log')
+    export_parser = subparsers.add_parser('export', help='Export poses in the layout of pose.csv')
+    export_parser.add_argument('log')
+    export_parser.add_argument('csv')
+    export_parser.add_argument('--start', type=float, default=None, help='Seconds after the first pose')
+    export_parser.add_argument('--end', type=float, default=None, help='Seconds after the first pose')
+    export_parser.add_argument('--inferred-only', action='store_true', help='Skip the predicted poses')
+    args = parser.parse_args()
+
+    log = PoseLog(args.log)
+    if len(log) == 0:
+        print('%s holds no poses' % args.log)
+        return
+    t0 = log.start_time()
+    if args.command == 'info':
+        records = log.slice()
+        print('%i poses (%i inferred) over %.1f s' % (len(records), np.count_nonzero(records['inferred']),
+                                                      records['time'][-1] - t0))
+    else:
+        n = log.export_csv(args.csv, None if args.start is None else t0 + args.start,
+                           None if args.end is None else t0 + args.end, args.inferred_only)
+        print('Exported %i poses to %s' % (n, args.csv))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Temporal tracking of the MoveNet pose.
+
+Every keypoint is smoothed over time with a One-Euro filter: slow movements are filtered strongly (no jitter), fast
+movements hardly (little lag). Keypoints with a low score pull the filtered pose less than confident ones. The filter
+also estimates the velocity of every keypoint, so the pose can be predicted on frames on which MoveNet does not run,
+which lets the inference run at a lower rate while the overlay still moves smoothly. Finally, the next inference only
+looks at a square region around the last pose instead of the whole (squeezed) frame, which gives MoveNet more pixels
+of the person for the same input size.
+"""
+
+import math
+
+import numpy as np
+
+
+def _alpha(dt, cutoff):
+    """Smoothing factor of an exponential filter with the given cutoff frequency [Hz] at time step dt [s]."""
+    tau = 1.0 / (2 * math.pi * cutoff)
+    return 1.0 / (1.0 + tau / dt)
+
+
+class OneEuroFilter(object):
+    """One-Euro filter (Casiez et al. 2012) over an array of values, e.g. all keypoint coordinates at once."""
+
+    def __init__(self, min_cutoff=1.0, beta=5.0, d_cutoff=1.0):
+        self.min_cutoff = min_cutoff  # Cutoff frequency [Hz] at rest, lower -> less jitter
+        self.beta = beta  # Increase of the cutoff with the speed, higher -> less lag
+        self.d_cutoff = d_cutoff  # Cutoff frequency [Hz] of the velocity estimate
+        self.reset()
+
+    def reset(self):
+        self.x = None  # Filtered values
+        self.dx = None  # Filtered derivative of the samples [1/s], which adapts the cutoff
+        self.velocity = None  # Filtered velocity of the filtered values [1/s], for predictions
+        self.t = None  # Time of the last sample [s]
+
+    def __call__(self, x, t, weight=1.0):
+        """Filters the new sample x taken at time t. weight (0..1, can be an array) scales how much the sample may
+        move the filtered value."""
+        if self.x is None:
+            self.x = np.array(x, dtype=np.float32)
+            self.dx = np.zeros_like(self.x)
+            self.velocity = np.zeros_like(self.x)
+            self.t = t
+            return self.x
+        dt = max(t - self.t, 1e-3)
+
+        self.dx += _alpha(dt, self.d_cutoff) * ((x - self.x) / dt - self.dx)
+        cutoff = self.min_cutoff + self.beta * np.abs(self.dx)
+        step = weight * _alpha(dt, cutoff) * (x - self.x)
+        self.x += step
+        # The velocity of the filtered values (not of the raw samples) predicts without jumping ahead of the filter
+        self.velocity += _alpha(dt, self.d_cutoff) * (step / dt - self.velocity)
+        self.t = t
+        return self.x
+
+    def predict(self, t):
+        """Extrapolates the filtered values to time t with the estimated velocity."""
+        return self.x + self.velocity * (t - self.t)
+
+
+class PoseTracker(object):
+    """Runs MoveNet on a region around the last pose, smooths the keypoints and predicts them in between."""
+
+    def __init__(self, min_score=0.3, min_keypoints=5, padding=0.3, min_crop=0.3, max_prediction=0.5,
+                 min_cutoff=1.0, beta=5.0, score_smoothing=0.5):
+        self.min_score = min_score  # Keypoints above this score count as found
+        self.min_keypoints = min_keypoints  # Crop around the pose only if at least this many keypoints were found
+        self.padding = padding  # Padding around the keypoints in the crop, relative to the size of the pose
+        self.min_crop = min_crop  # Minimum size of the crop, relative to the longer side of the frame
+        self.max_prediction = max_prediction  # Predict at most this long [s] after the last inference, then hold
+        self.score_smoothing = score_smoothing  # Weight of the newest score in the smoothed scores
+
+        self.filter = OneEuroFilter(min_cutoff, beta)
+        self.scores = None  # Smoothed score of every keypoint
+
+    def reset(self):
+        """Forgets the pose, e.g. when pose detection was switched off."""
+        self.filter.reset()
+        self.scores = None
+
+    @property
+    def pose(self):
+        """Filtered (y, x, score) of every keypoint at the time of the last inference, or None."""
+        if self.filter.x is None:
+            return None
+        return np.column_stack([self.filter.x, self.scores])
+
+    def crop(self, frame):
+        """Returns the part of the frame that MoveNet should run on and its region (None -> the whole frame)."""
+        region = self.crop_region(*frame.shape[:2])
+        if region is None:
+            return frame, None
+        y0, x0, size = region
+        return frame[y0:y0 + size, x0:x0 + size], region
+
+    def add(self, pose, region, shape, t):
+        """Filters the keypoints that MoveNet found in the region (see crop) of a frame with this shape, taken at time
+        t, and returns the filtered pose, relative to the whole frame."""
+        if region is not None:
+            # Map the keypoints in the crop back to the whole frame
+            height, width = shape[:2]
+            y0, x0, size = region
+            pose[:, 0] = (y0 + pose[:, 0] * size) / height
+            pose[:, 1] = (x0 + pose[:, 1] * size) / width
+
+        scores = pose[:, 2]
+        if self.scores is None:
+            self.scores = scores.copy()
+        else:
+            self.scores += self.score_smoothing * (scores - self.scores)
+        # Uncertain keypoints move the filtered position less
+        self.filter(pose[:, :2], t, weight=np.clip(scores / self.min_score, 0, 1)[:, None])
+        return self.pose
+
+    def predict(self, t):
+        """Returns the pose extrapolated to time t (for frames without inference), or None if there is none."""
+        if self.filter.x is None:
+            return None
+        dt = min(t - self.filter.t, self.max_prediction)
+        return np.column_stack([np.clip(self.filter.predict(self.filter.t + dt), 0, 1), self.scores])
+
+    def crop_region(self, height, width):
+        """Returns (y0, x0, size) of a square region around the last pose in pixels, or None for the whole frame."""
+        pose = self.pose
+        if pose is None:
+            return None
+        found = pose[:, 2] > self.min_score
+        if np.count_nonzero(found) < self.min_keypoints:
+            return None
+
+        ys, xs = pose[found, 0] * height, pose[found, 1] * width
+        center_y, center_x = (ys.min() + ys.max()) / 2, (xs.min() + xs.max()) / 2
+        size = max(ys.max() - ys.min(), xs.max() - xs.min()) * (1 + 2 * self.padding)
+        size = int(max(size, self.min_crop * max(height, width)))
+        if size >= min(height, width):
+            return None  # The person fills the frame, the crop would not help
+
+        # Shift the square into the frame instead of cutting it off
+        y0 = int(min(max(center_y - size / 2, 0), height - size))
+        x0 = int(min(max(center_x - size / 2, 0), width - size))
+        return y0, x0, size
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Threaded frame processing of the camera stream.
+
+The FrameProcessor takes every new camera frame, runs the enabled processing stages on it exactly once and publishes
+the annotated JPEG to an AnnotatedOutput, from where it is fanned out to all streaming clients. It opens no hardware
+itself: the face detector and the Coral interpreters are handed in, so it can also run off-robot with stand-ins
+(see benchmark.py). The interpreters can also be models.LazyModel objects, which load in the background while the
+stream already runs; their stages are skipped until they are ready. The interpreters are only used through an
+inference.InferenceService; if none is handed in, the processor runs its requests synchronously.
+"""
+
+import logging
+import time
+from threading import Condition, Thread
+
+import cv2
+
+import vision
+import overlay
+import models
+import latency
+from tracking import FaceTracker, RecognitionCache
+from face_writer import FaceWriter
+from face_store import FaceStore
+from metrics import Metrics
+from scheduler import StageScheduler
+from pose_tracking import PoseTracker
+from pose_recorder import PoseRecorder
+from inference import InferenceService
+
+
+class AnnotatedOutput(object):
+    """Holds the latest processed JPEG frame, which is fanned out to all streaming clients.
+
+    With encode_unwatched=False, frames are only drawn and JPEG encoded while someone watches the MJPEG stream; the
+    detections are always handed to the overlay listeners as JSON (for the H.264 viewers, see h264_stream.py).
+    """
+
+    def __init__(self, encode_unwatched=True):
+        self.frame = None
+        self.seq = 0  # Sequence number of the latest frame
+        self.condition = Condition()
+        self.listeners = []  # Callbacks that are called after every new frame, e.g. by the asyncio server
+        self.overlay_listeners = []  # Callbacks that get the detections of every frame as JSON
+        self.encode_unwatched = encode_unwatched
+        self.viewers = 0  # Number of connected MJPEG clients
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def add_overlay_listener(self, callback):
+        self.overlay_listeners.append(callback)
+
+    def add_viewer(self, n=1):
+        """Counts MJPEG clients that connect (n=1) or leave (n=-1)."""
+        with self.condition:
+            self.viewers += n
+
+    def wants_jpeg(self):
+        """Whether the next frame needs to be drawn and encoded."""
+        return self.encode_unwatched or self.viewers > 0
+
+    def publish_overlay(self, data):
+        """Hands the detections of a frame (JSON, see overlay.detections_json) to the overlay listeners."""
+        for callback in self.overlay_listeners:
+            callback(data)
+
+    def publish(self, frame):
+        # Replace the current frame and wake up all clients waiting for a new one
+        with self.condition:
+            self.frame = frame
+            self.seq += 1
+            self.condition.notify_all()
+        for callback in self.listeners:
+            callback()
+
+    def latest(self):
+        """Returns (seq, frame) of the latest frame without waiting."""
+        with self.condition:
+            return self.seq, self.frame
+
+    def wait(self, last_seq):
+        """Blocks until there is a frame newer than last_seq and returns (seq, frame)."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > last_seq)
+            return self.seq, self.frame
+
+
+class FrameProcessor(Thread):
+    """Single producer that processes every camera frame exactly once and publishes the annotated JPEG."""
+
+    def __init__(self, source, sink, stages, det, face_interpreter=None, pose_interpreter=None, capture_mode='mjpeg',
+                 analysis=None, min_face_size=152, detect_interval=1, face_store=None, face_label=None, pose_log=None,
+                 scheduler=None, metrics=None, tracer=None, inference=None):
+        super().__init__(daemon=True)
+        self.source = source  # FrameBuffer/YUVOutput where the camera writes the raw frames into
+        self.sink = sink  # AnnotatedOutput where the processed frames are published for the clients
+        self.det = det
+        # Runs face recognition and pose detection, in a background thread if the service was started
+        if inference is None:
+            inference = InferenceService({'face': face_interpreter, 'pose': pose_interpreter})
+        self.inference = inference
+        self.capture_mode = capture_mode  # 'mjpeg' or 'yuv', the format that the camera records the source in
+        self.analysis = analysis  # Optional YUVOutput with the small frames for detection and inference
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.tracer = tracer  # Optional latency.LatencyTracer that follows every frame from capture to the stream
+        self.trace = None  # Trace of the frame that is currently processed
+
+        # Decides which of the enabled stages (detect_faces, save_faces, recognise_faces, detect_poses) run on a frame,
+        # the stages can be switched while the stream runs
+        self.scheduler = scheduler if scheduler is not None else StageScheduler(stages)
+
+        # Collects sharp face crops for the training data set in a background thread, as PNG files or packed into
+        # the face store directory. Created when saving is switched on for the first time.
+        self.face_store = face_store
+        self.face_label = face_label
+        self.saver = None
+
+        # Follows the faces between frames, with a full detection on every frame if detect_interval is 1
+        self.tracker = FaceTracker(None, detect_interval=detect_interval, min_size=(min_face_size, min_face_size))
+
+        # Remembers who each tracked face is, so the TPU doesn't need to look at the same face on every frame
+        self.recognition_cache = RecognitionCache()
+
+        # Smooths the pose over time and predicts it on frames on which the scheduler skips the pose detection
+        self.pose_tracker = PoseTracker()
+
+        # Optionally records every pose (inferred or predicted) to a pose log directory in a background thread
+        self.recorder = None
+        if pose_log is not None:
+            self.recorder = PoseRecorder(pose_log, metrics=self.metrics)
+            self.recorder.start()
+
+        # Last results, which are drawn again on frames on which the scheduler skips a stage
+        self.tracks = []
+        self.live_ids = set()  # Tracks that the face tracker still follows, even if they were missed on this frame
+        self.pose = None
+        self.running = True
+
+    def stop(self):
+        """Ends the processing thread (if it runs) and writes out everything that the background writers still hold:
+        saved faces, recorded poses and the queued TPU requests."""
+        self.running = False
+        if self.is_alive():
+            self.join()
+        self.inference.stop()
+        if self.saver is not None:
+            self.saver.stop()
+        if self.recorder is not None:
+            self.recorder.stop()
+
+    def run(self):
+        last_seq = 0
+        while self.running:
+            # Wait until the camera delivered a frame that has not been processed yet. Frames that arrive while the
+            # previous one is still processed are skipped, so the stream never lags behind the camera. The timeout
+            # lets the thread notice stop() when the camera stopped recording.
+            seq, last_frame, missed = self.source.wait(last_seq, timeout=0.5)
+            if seq == last_seq:
+                continue
+            last_seq = seq
+            self.metrics.count('dropped_frames', missed)
+
+            # Process outside of the lock, so the camera can keep writing new frames in the meantime
+            try:
+                self.handle(last_seq, last_frame)
+            except Exception as e:
+                logging.warning('Could not process frame: %s', str(e))
+
+    def handle(self, seq, raw):
+        """Decodes one raw frame from the source, runs all stages on it and publishes the result. Returns False if
+        the frame had to be skipped."""
+        metrics = self.metrics
+        start = time.perf_counter()
+        if self.tracer is not None:
+            self.trace = self.tracer.begin(seq, self.source.capture_time(seq))
+
+        analysis = None
+        if self.analysis is not None:
+            with metrics.time('decode_analysis'):
+                analysis = self.analysis_frame()
+            if analysis is None:
+                return False  # The small stream did not deliver its first frame yet
+
+        if self.capture_mode == 'yuv':
+            # The camera must not overwrite the raw buffer while it is processed
+            raw = self.source.acquire()
+            try:
+                with metrics.time('decode'):
+                    frame, gray = self.source.bgr(raw), self.source.gray(raw)
+                latency.mark(self.trace, 'decode')
+                frame = self.process(frame, gray, analysis)
+            finally:
+                self.source.release()
+        else:
+            ### The image is encoded in bytes,
+            ### needs to be converted to e.g. numpy array
+            with metrics.time('decode'):
+                frame = vision.decode_frame(raw)
+            if not self.source.valid(seq):
+                metrics.count('dropped_frames')
+                return False  # The camera overwrote the frame while it was decoded
+            latency.mark(self.trace, 'decode')
+            frame = self.process(frame, analysis=analysis)
+
+        if frame is not None:
+            self.sink.publish(frame)
+        if self.tracer is not None:
+            self.tracer.finish(self.trace, 'glass_to_glass')
+        total = time.perf_counter() - start
+        metrics.observe('total', total)
+        metrics.frame_published()
+        self.scheduler.update(total)
+        return True
+
+    def analysis_frame(self):
+        """Returns the BGR and greyscale image of the latest small analysis frame, or None if there is none yet."""
+        raw = self.analysis.acquire()
+        try:
+            if raw is None:
+                return None
+            # The small greyscale frame is copied, so the raw buffer can be released right away
+            return self.analysis.bgr(raw), self.analysis.gray(raw).copy()
+        finally:
+            self.analysis.release()
+
+    def process(self, frame, gray=None, analysis=None):
+        """Runs all enabled processing stages on one BGR frame and returns the annotated frame as JPEG, or None if
+        nobody watches the MJPEG stream (the detections only go to the overlay listeners then).
+
+        If the greyscale version of the frame is already known (Y plane of raw frames), it is used for face detection.
+        In dual-resolution mode, analysis holds the (BGR, greyscale) small frame that detection and inference run on;
+        the detections are then scaled up to the streamed frame.
+        """
+        metrics = self.metrics
+        enabled, due = self.scheduler.plan()
+        if analysis is None:
+            small, small_gray = frame, gray
+        else:
+            small, small_gray = analysis
+        scale = vision.frame_scale(frame.shape, small.shape)
+
+        ###############
+        ## HERE CAN GO ALL IMAGE PROCESSING
+        ###############
+
+        ###############
+        ## POSE DETECTION
+        ###############
+
+        # The Edge TPU models run in the inference service: pose detection is submitted first and runs on the TPU
+        # while the CPU detects the faces, whose recognition is queued right behind it
+        now = time.monotonic()
+        pose_request = None
+        if not enabled['detect_poses']:
+            self.pose = None
+            self.pose_tracker.reset()
+        elif due['detect_poses'] and self.inference.ready('pose') is not None:
+            # Keypoints are relative to the image size, so they fit the streamed frame as well
+            pose_start = time.perf_counter()
+            crop, region = self.pose_tracker.crop(small)
+            pose_request = (self.inference.submit('pose', crop), region)
+            pose_time = time.perf_counter() - pose_start
+        else:
+            self.pose = self.pose_tracker.predict(now)
+
+        ###############
+        ## FACE DETECTION
+        ###############
+
+        if not enabled['detect_faces']:
+            self.tracks = []
+            self.live_ids = set()
+        elif due['detect_faces']:
+            det = models.ready(self.det)
+            if det is not None:
+                # Convert frame into greyscale for image processing
+                if small_gray is None:
+                    small_gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+                # Use face detector/tracker to find all faces in the current frame
+                self.tracker.det = det
+                with metrics.time('detect'):
+                    self.tracks = [(track.id, track.rect) for track in self.tracker.update(small_gray)]
+                self.live_ids = self.tracker.live_ids()
+        # On skipped frames, the faces stay where they were last found
+        tracks = self.tracks
+        latency.mark(self.trace, 'detect')
+        # Face positions in the coordinates of the streamed frame
+        rects = vision.scale_rects([rect for _, rect in tracks], scale)
+
+        ### Save detected faces
+        if enabled['save_faces'] and due['detect_faces'] and rects:
+            with metrics.time('save'):
+                self.face_writer().submit(frame, rects)
+
+        ### For every detected face, check if it is from the trained person or not
+        recognised = None
+        recognising = enabled['detect_faces'] and enabled['recognise_faces'] and \
+            self.inference.ready('face') is not None
+        if recognising and due['recognise_faces']:
+            recognise_start = time.perf_counter()
+            invokes = self.recognition_cache.invokes
+            recognised = self.recognition_cache.submit(self.inference, small, tracks, self.live_ids)
+            recognise_time = time.perf_counter() - recognise_start
+
+        ### Collect the results of the TPU
+        if pose_request is not None:
+            pose_start = time.perf_counter()
+            future, region = pose_request
+            self.pose = self.pose_tracker.add(vision.pose_keypoints(future.result()), region, small.shape, now)
+            metrics.observe('pose', pose_time + time.perf_counter() - pose_start)
+            metrics.count('pose_invokes')
+        latency.mark(self.trace, 'pose')
+        if self.recorder is not None and self.pose is not None:
+            self.recorder.record(time.time(), self.pose, pose_request is not None)
+
+        ##################################################
+        ### DRAW DETECTIONS ON THE FRAME BEFORE STREAMING
+        ##################################################
+
+        colors = []
+        if enabled['detect_faces']:
+            if recognised is not None:
+                recognise_start = time.perf_counter()
+                colors = recognised()
+                metrics.observe('recognise', recognise_time + time.perf_counter() - recognise_start)
+                metrics.count('face_invokes', self.recognition_cache.invokes - invokes)
+            elif recognising:
+                # Recognition skipped on this frame, every face keeps its last result
+                colors = self.recognition_cache.cached(tracks, self.live_ids)
+            else:
+                # If no face recognition (or the model is still loading), all rectangles should be green
+                colors = [(0, 255, 0)]*len(rects)
+
+            latency.mark(self.trace, 'recognise')
+
+        ### Viewers of the H.264 stream draw the detections themselves
+        if self.sink.overlay_listeners:
+            self.sink.publish_overlay(overlay.detections_json(frame.shape, rects, colors, self.pose))
+        if not self.sink.wants_jpeg():
+            return None
+
+        if enabled['detect_faces']:
+            ### DRAW RECTANGLE AROUND FACES
+            with metrics.time('draw'):
+                overlay.draw_faces(frame, rects, colors,
+                                  self.saver.face_i - 1 if self.saver is not None else None)
+
+        if self.pose is not None:
+            ### DRAW DOTS ON POSE KEYPOINTS
+            with metrics.time('draw'):
+                overlay.draw_pose(frame, self.pose)
+
+        latency.mark(self.trace, 'draw')
+
+        ### and now we convert it back to JPEG to stream it
+        with metrics.time('encode'):
+            jpeg = vision.encode_frame(frame)
+        latency.mark(self.trace, 'encode')
+        return jpeg
+
+    def face_writer(self):
+        """Returns the face writer, and starts it when the faces are saved for the first time."""
+        if self.saver is None:
+            store = FaceStore(self.face_store) if self.face_store is not None else None
+            self.saver = FaceWriter(store=store, label=self.face_label, metrics=self.metrics)
+            self.saver.start()
+        return self.saver
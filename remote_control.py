@@ -1,15 +1,9 @@
 import curses
-import serial
-import time
 
-# Configure serial port
-ser = serial.Serial()
-ser.baudrate = 19200
-ser.port = '/dev/ttyUSB0'
+from serial_client import SerialClient
 
-# Open serial port
-ser.open()
-time.sleep(2.00) # Wait for connection before sending any data
+# Open serial port, commands are sent without waiting for the Arduino's answer
+client = SerialClient('/dev/ttyUSB0', 19200)
 
 # get the curses screen window
 screen = curses.initscr()
@@ -23,36 +17,25 @@ curses.cbreak()
 # map arrow keys to special values
 screen.keypad(True)
 
-arduino = []
-
 try:
     while True:
         char = screen.getch()
         if char == ord('x'):
             break
         elif char == ord(' '):
-            # Send a character
-            ser.write(b't0;')
-            time.sleep(0.05)
-            arduino.append(ser.readline())
-            arduino.append(ser.readline())
+            # Send "t" for terminate to halt the robot
+            client.stop()
         else:
-            # Send any character
-            var_char = '{}0;'.format(chr(char))     # char is the unicode integer of the key, so we have to transform it back into the string character before formatting
-            ser.write(var_char.encode('utf-8'))     # Arduino expects a byte instead of a string, so encode it before sending it
-            time.sleep(0.05)
-            arduino.append(ser.readline())
-            arduino.append(ser.readline())
+            # Send any character (char is the unicode integer of the key, so transform it back into the character)
+            client.send(chr(char))
 finally:
     # shut down
     curses.nocbreak()
     screen.keypad(0)
     curses.echo()
     curses.endwin()
-    # Close serial port
-    #s = ser.read(1)
-    #print(s)
-    print(arduino)
-    ser.close()
+    # Close serial port, and show how fast the Arduino answered
+    print(client.latency())
+    client.close()
 
 
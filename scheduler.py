@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runtime control of the processing stages and a frame time budget.
+
+The stages (detect_faces, save_faces, recognise_faces, detect_poses) can be switched on and off while the stream runs,
+through the /stages endpoint of the streaming servers:
+
+    curl http://robot:8000/stages                                     # current settings as JSON
+    curl -X POST 'http://robot:8000/stages?detect_poses=1&target_fps=12'
+
+With a target frame rate, the scheduler watches the processing time per frame. When it exceeds the frame budget, the
+expensive stages only run every n-th frame (pose first, then face recognition, then face detection), and the frames in
+between reuse their last result. When there is enough headroom again, the stages run more often again. Under load the
+stream therefore gets less fresh annotations instead of falling behind the camera.
+"""
+
+import logging
+from threading import Lock
+from urllib.parse import parse_qsl
+
+# Stages that may run less often under load, in the order they are slowed down, with their longest interval [frames]
+DEGRADE_ORDER = ('detect_poses', 'recognise_faces', 'detect_faces')
+MAX_INTERVALS = {'detect_poses': 4, 'recognise_faces': 5, 'detect_faces': 3}
+
+
+def _parse_bool(value):
+    if value.lower() in ('1', 'true', 'on', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'off', 'no'):
+        return False
+    raise ValueError('Not a boolean: %s' % value)
+
+
+class StageScheduler(object):
+    """Holds the switches of the processing stages and decides for every frame which of them run."""
+
+    def __init__(self, stages, target_fps=None, min_intervals=None, smoothing=0.1, headroom=0.75, cooldown=12,
+                 metrics=None):
+        self.stages = dict(stages)  # Which stages are enabled
+        self.target_fps = target_fps  # Frame rate that the processing should keep up with (None -> no budget)
+        self.smoothing = smoothing  # Weight of the newest frame in the smoothed frame time
+        self.headroom = headroom  # Stages speed up again when the frame time is below this fraction of the budget
+        self.cooldown = cooldown  # Minimum number of frames between two changes, so the frame time can settle
+        self.metrics = metrics  # Optional Metrics that get the current intervals as gauges
+
+        # Stage -> runs at least/currently every n-th frame, e.g. pose only every 2nd frame because the frames in
+        # between are predicted
+        self.min_intervals = {stage: 1 for stage in DEGRADE_ORDER}
+        self.min_intervals.update(min_intervals or {})
+        self.intervals = dict(self.min_intervals)
+        self.frame_time = None  # Smoothed processing time per frame [s]
+        self.frame_i = 0
+        self.last_change = 0  # Frame of the last interval change
+        self.lock = Lock()
+
+    def plan(self):
+        """Call once per frame. Returns which stages are enabled and which of them are due on this frame; enabled
+        stages that are not due reuse their last result."""
+        with self.lock:
+            self.frame_i += 1
+            enabled = dict(self.stages)
+            due = dict(enabled)
+            for i, stage in enumerate(DEGRADE_ORDER):
+                # Offset the stages against each other, so they don't all run on the same frame
+                due[stage] = enabled.get(stage, False) and (self.frame_i + i) % self.intervals[stage] == 0
+        return enabled, due
+
+    def update(self, seconds):
+        """Call once per frame with the time the processing of the frame took."""
+        with self.lock:
+            if self.frame_time is None:
+                self.frame_time = seconds
+            else:
+                self.frame_time += self.smoothing * (seconds - self.frame_time)
+            if self.target_fps is None or self.frame_i - self.last_change < self.cooldown:
+                return
+
+            budget = 1 / self.target_fps
+            if self.frame_time > budget:
+                # Over budget: run the next stage in line less often
+                for stage in DEGRADE_ORDER:
+                    if self.stages[stage] and self.intervals[stage] < max(MAX_INTERVALS[stage],
+                                                                          self.min_intervals[stage]):
+                        self._set_interval(stage, self.intervals[stage] + 1)
+                        break
+            elif self.frame_time < self.headroom * budget:
+                # Enough headroom: undo the last slow-down first
+                for stage in reversed(DEGRADE_ORDER):
+                    if self.intervals[stage] > self.min_intervals[stage]:
+                        self._set_interval(stage, self.intervals[stage] - 1)
+                        break
+
+    def _set_interval(self, stage, interval):
+        if interval == self.intervals[stage]:
+            return
+        logging.info('Frame time %.1f ms: %s now runs every %i frame(s)', (self.frame_time or 0) * 1000, stage,
+                     interval)
+        self.intervals[stage] = interval
+        self.last_change = self.frame_i
+        if self.metrics is not None:
+            self.metrics.set_gauge('interval_%s' % stage, interval)
+
+    def configure(self, query):
+        """Applies the settings of a query string, e.g. 'detect_poses=1&target_fps=12' ('target_fps=none' removes
+        the budget). Raises ValueError for unknown settings or values, in which case nothing is changed."""
+        updates = {}
+        target_fps = self.target_fps
+        for key, value in parse_qsl(query, keep_blank_values=True):
+            if key in self.stages:
+                updates[key] = _parse_bool(value)
+            elif key == 'target_fps':
+                target_fps = None if value.lower() in ('', 'none', '0') else float(value)
+                if target_fps is not None and target_fps <= 0:
+                    raise ValueError('target_fps must be positive')
+            else:
+                raise ValueError('Unknown setting: %s' % key)
+
+        with self.lock:
+            self.stages.update(updates)
+            if target_fps != self.target_fps:
+                self.target_fps = target_fps
+                # Start over with all stages on every frame, the budget adapts again from there
+                for stage in self.intervals:
+                    self._set_interval(stage, self.min_intervals[stage])
+            for stage, on in updates.items():
+                if not on and stage in self.intervals:
+                    self._set_interval(stage, self.min_intervals[stage])
+        logging.info('Stages changed: %s', self.state())
+
+    def state(self):
+        """Returns the settings and the current intervals, e.g. for the /stages endpoint."""
+        with self.lock:
+            return {'stages': dict(self.stages), 'target_fps': self.target_fps, 'intervals': dict(self.intervals),
+                    'frame_time_ms': self.frame_time * 1000 if self.frame_time is not None else None}
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Non-blocking serial connection to the Arduino motor controller (Arduino/serial_server.ino).
+
+Commands are written to the port right away, the control loop never sleeps or waits for an answer. A background thread
+reads the acknowledgements of the Arduino, matches them to the sent commands and keeps the last acknowledgements with
+their round-trip time in a bounded ring.
+
+The Arduino understands two protocols, which can be mixed:
+    - text: one command character and a value, terminated by ';' (e.g. 'w0;'), for the fixed moves w/s/a/d/q/e/t. The
+      Arduino echoes command and value on two lines.
+    - binary: fixed-size packets with a signed PWM value (-255..255) for each wheel and a checksum, see PACKET_FORMAT.
+      Packets can ask for a 3-byte acknowledgement or be sent without one, e.g. for steering at 100 Hz. If no packet
+      arrives for half a second, the Arduino stops the motors.
+With protocol='binary', drive() sends packets; with 'text', it falls back to the nearest fixed move.
+
+Steering commands are coalesced: a command that repeats the last one is not sent again (unless the last one is older
+than repeat_interval, which keeps the watchdog of the sketch fed), and while the Arduino still has max_in_flight
+commands unanswered, only the newest command is held back and sent with the next acknowledgement. The stop command
+always goes out immediately.
+
+    client = SerialClient(protocol='binary')
+    client.drive(200, 120)
+    ...
+    client.stop()
+    print(client.latency())
+    client.close()
+"""
+
+import logging
+import struct
+import time
+from collections import deque
+from threading import Lock, Thread
+
+import serial
+
+STOP = 't'  # Text command that halts the motors, it is never coalesced or held back
+
+# Binary packet: start byte, sequence number, left and right PWM (int16, little endian), flags, checksum. The start
+# bytes are no ASCII characters, so packets and acknowledgements can't be confused with the text protocol.
+PACKET_FORMAT = '<BBhhBB'
+PACKET_START = 0xA5
+ACK_START = 0xA6  # Acknowledgement: start byte, sequence number, checksum
+ACK_SIZE = 3
+FLAG_ACK = 0x01  # The Arduino acknowledges the packet
+MAX_PWM = 255
+
+
+def checksum(data):
+    """XOR of all bytes, inverted so that a packet of zeros does not have a zero checksum."""
+    value = 0xFF
+    for byte in data:
+        value ^= byte
+    return value
+
+
+def encode_command(command, value=0):
+    """Bytes of a text command in the format of serial_server.ino, e.g. ('w', 0) -> b'w0;'."""
+    return ('%s%i;' % (command, value)).encode('utf-8')
+
+
+def encode_drive(seq, left, right, ack=True):
+    """Bytes of a binary packet that sets the PWM of both wheels (negative -> backwards)."""
+    packet = struct.pack(PACKET_FORMAT, PACKET_START, seq, left, right, FLAG_ACK if ack else 0, 0)
+    return packet[:-1] + bytes([checksum(packet[1:-1])])
+
+
+def nearest_command(left, right):
+    """Fixed move of the text protocol that comes closest to the wheel speeds."""
+    if left == 0 and right == 0:
+        return STOP
+    if left >= 0 and right >= 0:
+        if abs(left - right) < max(left, right) / 4:
+            return 'w'
+        return 'e' if left > right else 'q'  # Slight turn towards the slower wheel
+    if left <= 0 and right <= 0:
+        return 's'
+    # Wheels in opposite directions: sharp turn, with the wheel directions of 'a' and 'd' in the sketch
+    return 'a' if left > right else 'd'
+
+
+class SerialClient(object):
+    """Sends commands to the Arduino without blocking and collects its acknowledgements in a background thread."""
+
+    def __init__(self, port='/dev/ttyUSB0', baudrate=19200, protocol='text', settle=2.0, repeat_interval=0.2,
+                 max_in_flight=2, ack_timeout=1.0, max_acks=256, metrics=None):
+        if protocol not in ('text', 'binary'):
+            raise ValueError('Unknown protocol: %s' % protocol)
+        self.protocol = protocol  # How drive() commands are sent
+        self.repeat_interval = repeat_interval  # Identical commands are sent again after this time [s] (< watchdog)
+        self.max_in_flight = max_in_flight  # Number of unanswered commands after which new ones are held back
+        self.ack_timeout = ack_timeout  # Commands that are not acknowledged within this time [s] count as lost
+        self.metrics = metrics  # Optional Metrics that get the round-trip times and the command counters
+
+        # Short read timeout, so the reader thread notices when the client is closed
+        self.ser = serial.Serial(port, baudrate, timeout=0.1)
+        time.sleep(settle)  # The Arduino resets when the port is opened, wait before sending any data
+
+        self.lock = Lock()
+        # Commands are (command, value) in the text protocol and ('drive', left, right) in the binary protocol
+        self.in_flight = deque()  # (acknowledgement key, send time) of the sent commands without acknowledgement
+        self.pending = None  # Newest (command, ack) that waits until fewer commands are in flight
+        self.last_sent = None  # (command, send time) of the last written command
+        self.acks = deque(maxlen=max_acks)  # (receive time, acknowledgement key, round-trip time [s]) of recent answers
+        self.seq = 0  # Sequence number of the last binary packet
+        self.counts = {'sent': 0, 'coalesced': 0, 'lost': 0, 'corrupt': 0}
+
+        self.running = True
+        self.reader = Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send(self, command, value=0):
+        """Sends a text command without waiting. Returns False if it was coalesced with an earlier one."""
+        return self._submit((command, value))
+
+    def drive(self, left, right, ack=True):
+        """Sets the PWM of both wheels (-255..255, negative -> backwards) without waiting. Without ack, the packet is
+        fire-and-forget and never held back. Returns False if it was coalesced with an earlier command."""
+        left = int(max(-MAX_PWM, min(MAX_PWM, left)))
+        right = int(max(-MAX_PWM, min(MAX_PWM, right)))
+        if self.protocol == 'text':
+            return self.send(nearest_command(left, right))
+        return self._submit(('drive', left, right), ack)
+
+    def stop(self):
+        """Halts the motors."""
+        if self.protocol == 'binary':
+            self.drive(0, 0)
+        else:
+            self.send(STOP)
+
+    def close(self):
+        self.running = False
+        self.reader.join()
+        self.ser.close()
+
+    def latency(self):
+        """Round-trip times of the recent acknowledgements [ms] and the command counters."""
+        with self.lock:
+            times = sorted(ack[2] * 1000 for ack in self.acks)
+            stats = dict(self.counts, in_flight=len(self.in_flight))
+        if times:
+            stats.update(n=len(times), p50=times[len(times) // 2],
+                         p90=times[min(len(times) - 1, int(0.9 * len(times)))], max=times[-1])
+        return stats
+
+    def _submit(self, command, ack=True):
+        now = time.monotonic()
+        with self.lock:
+            if command[0] == STOP or command == ('drive', 0, 0):
+                # Halting is never delayed, and nothing that was held back may start the motors again
+                self.pending = None
+            elif self.last_sent is not None and self.last_sent[0] == command and \
+                    now - self.last_sent[1] < self.repeat_interval:
+                self._count('coalesced')
+                return False
+            elif ack and len(self.in_flight) >= self.max_in_flight:
+                # The Arduino is behind: only the newest command is kept and sent when it answers
+                if self.pending is not None:
+                    self._count('coalesced')
+                self.pending = (command, ack)
+                return True
+            self._write(command, ack, now)
+        return True
+
+    def _count(self, name):
+        self.counts[name] += 1
+        if self.metrics is not None:
+            self.metrics.count('serial_%s' % name)
+
+    def _write(self, command, ack, now):
+        """Writes a command to the port, only call with the lock held."""
+        if command[0] == 'drive':
+            self.seq = (self.seq + 1) % 256
+            self.ser.write(encode_drive(self.seq, command[1], command[2], ack))
+            key = self.seq
+        else:
+            self.ser.write(encode_command(*command))
+            key = command[0]
+        self.last_sent = (command, now)
+        if ack:
+            self.in_flight.append((key, now))
+        self._count('sent')
+
+    def _read(self):
+        buffer = b''
+        while self.running:
+            try:
+                # Wait for the first byte (up to the read timeout), then take everything that arrived
+                data = self.ser.read(1)
+                data += self.ser.read(self.ser.in_waiting)
+            except serial.SerialException as e:
+                logging.warning('Could not read from the Arduino: %s', str(e))
+                break
+            now = time.monotonic()
+            if not data:
+                self._expire(now)
+                continue
+            buffer = self._parse(buffer + data, now)
+
+    def _parse(self, buffer, now):
+        """Handles all complete acknowledgements in the received bytes and returns the incomplete rest."""
+        echo = None  # Command of a text echo whose value line is still missing
+        while buffer:
+            if buffer[0] == ACK_START:
+                if len(buffer) < ACK_SIZE:
+                    break
+                if checksum(buffer[1:2]) == buffer[2]:
+                    self._acknowledge(buffer[1], now)
+                    buffer = buffer[ACK_SIZE:]
+                else:
+                    self._count('corrupt')
+                    buffer = buffer[1:]  # Look for the next start byte
+                continue
+            if not self._text_expected(buffer[0]):
+                # Rest of a corrupt acknowledgement or line noise, which never ends with a newline: skip to the next
+                # start byte instead of waiting for one
+                start = buffer.find(bytes([ACK_START]), 1)
+                buffer = buffer[start:] if start >= 0 else b''
+                continue
+
+            # The text protocol echoes the command and its value on two lines
+            end = buffer.find(b'\n')
+            if end < 0:
+                break
+            line = buffer[:end].decode('utf-8', 'replace').strip()
+            if echo is not None and line.lstrip('-').isdigit():
+                self._acknowledge(echo, now)
+                echo = None
+            elif line:
+                echo = line
+            buffer = buffer[end + 1:]
+        if echo is not None:
+            # Keep the unanswered command line for the next call
+            buffer = echo.encode('utf-8') + b'\n' + buffer
+        return buffer
+
+    def _text_expected(self, byte):
+        """Whether a byte outside of an acknowledgement can start a text echo."""
+        if not (0x20 <= byte < 0x7F or byte in b'\r\n\t'):
+            return False
+        if self.protocol == 'text':
+            return True
+        # With the binary protocol, only text commands sent with send() are echoed
+        with self.lock:
+            return any(isinstance(key, str) for key, _ in self.in_flight)
+
+    def _acknowledge(self, key, now):
+        with self.lock:
+            # Commands before the acknowledged one were lost on the way
+            while self.in_flight and self.in_flight[0][0] != key:
+                self.in_flight.popleft()
+                self._count('lost')
+            if not self.in_flight:
+                return
+            _, sent = self.in_flight.popleft()
+            self.acks.append((now, key, now - sent))
+            if self.metrics is not None:
+                self.metrics.observe('serial_rtt', now - sent)
+            self._send_pending(now)
+
+    def _expire(self, now):
+        with self.lock:
+            while self.in_flight and now - self.in_flight[0][1] > self.ack_timeout:
+                self.in_flight.popleft()
+                self._count('lost')
+            self._send_pending(now)
+
+    def _send_pending(self, now):
+        """Sends the held back command if the Arduino caught up, only call with the lock held."""
+        if self.pending is not None and len(self.in_flight) < self.max_in_flight:
+            command, ack = self.pending
+            self.pending = None
+            self._write(command, ack, now)
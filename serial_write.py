@@ -1,26 +1,22 @@
-import serial
 import time
 
-# Configure serial port
-ser = serial.Serial()
-ser.baudrate = 19200
-ser.port = '/dev/ttyUSB0'
+from serial_client import SerialClient
 
 # Open serial port
-ser.open()
-time.sleep(2.00) # Wait for connection before sending any data
+client = SerialClient('/dev/ttyUSB0', 19200)
 
 # Send a character
-ser.write(b'x')
+client.send('x')
 time.sleep(0.05)
 
 # Send a character
-ser.write(b'o')
+client.send('o')
 time.sleep(1.00)
 
 # Send a character
-ser.write(b'x')
+client.send('x')
 time.sleep(0.05)
 
-# Close serial port
-ser.close()
+# Show how long the Arduino took to answer, and close serial port
+print(client.latency())
+client.close()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stand-ins for the hardware of the robot, so the processing can run (and be measured) on a normal Linux computer.
+
+- FakeCamera replays recorded frames with the interface of picamera.PiCamera (start_recording/stop_recording)
+- StandInInterpreter mimics a tflite interpreter on the Edge TPU on the CPU. It works with pycoral.adapters.common,
+  and input_size/set_input/output_tensor below are copies of those helpers for computers without pycoral.
+"""
+
+import glob
+import mmap
+import os
+import threading
+import time
+
+import numpy as np
+import cv2
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+###############
+## FRAME SOURCES
+###############
+
+def read_mjpeg(path):
+    """Yields the JPEG frames (bytes) of a recorded MJPEG file, e.g. a saved /stream.mjpg."""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = mm.find(b'\xff\xd8')
+        while start != -1:
+            end = mm.find(b'\xff\xd9', start + 2)
+            if end == -1:
+                break
+            yield mm[start:end + 2]
+            start = mm.find(b'\xff\xd8', end + 2)
+
+
+def read_images(pattern):
+    """Yields the images (BGR) of a directory or a glob pattern, sorted by file name."""
+    if os.path.isdir(pattern):
+        fnames = [os.path.join(pattern, f) for f in os.listdir(pattern) if f.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        fnames = glob.glob(pattern)
+    for fname in sorted(fnames):
+        img = cv2.imread(fname)
+        if img is not None:
+            yield img
+
+
+def load_frames(source, resolution=(640, 480), max_frames=None):
+    """Loads the frames of an MJPEG file, an image directory or a glob pattern as BGR images of the given size."""
+    if os.path.isfile(source) and not source.lower().endswith(IMAGE_EXTENSIONS):
+        images = (cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR) for jpeg in read_mjpeg(source))
+    else:
+        images = read_images(source)
+
+    frames = []
+    for img in images:
+        if max_frames is not None and len(frames) >= max_frames:
+            break
+        if img is not None:
+            frames.append(cv2.resize(img, tuple(resolution)))
+    if not frames:
+        raise ValueError('No frames found in %s' % source)
+    return frames
+
+
+def encode_frames(frames, format='mjpeg', resolution=None):
+    """Encodes BGR frames the way the camera delivers them: JPEG bytes ('mjpeg') or padded YUV420 bytes ('yuv')."""
+    encoded = []
+    for frame in frames:
+        if resolution is not None and (frame.shape[1], frame.shape[0]) != tuple(resolution):
+            frame = cv2.resize(frame, tuple(resolution))
+        if format == 'mjpeg':
+            encoded.append(cv2.imencode('.JPEG', frame)[1].tobytes())
+        elif format == 'yuv':
+            # Like the camera, pad the frame to a width of a multiple of 32 and a height of a multiple of 16
+            height, width = frame.shape[:2]
+            pad_w, pad_h = (-width) % 32, (-height) % 16
+            if pad_w or pad_h:
+                frame = cv2.copyMakeBorder(frame, 0, pad_h, 0, pad_w, cv2.BORDER_CONSTANT)
+            encoded.append(cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420).tobytes())
+        else:
+            raise ValueError('Unsupported format %s' % format)
+    return encoded
+
+
+class FakeCamera(object):
+    """Replays frames in real time into camera outputs, with the same recording interface as picamera.PiCamera."""
+
+    def __init__(self, frames, resolution=(640, 480), framerate=24, loop=True):
+        self.frames = frames  # BGR frames that are replayed
+        self.resolution = tuple(resolution)
+        self.framerate = framerate
+        self.loop = loop  # Start again with the first frame after the last one
+        self.vflip = False
+        self.awb_mode = 'auto'
+        self._recordings = {}  # Splitter port -> (replay thread, stop event)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start_recording(self, output, format='mjpeg', splitter_port=1, resize=None):
+        # Encode everything in advance, so the replay itself costs (almost) no CPU time
+        encoded = encode_frames(self.frames, format, resize or self.resolution)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._replay, args=(output, encoded, stop), daemon=True)
+        self._recordings[splitter_port] = (thread, stop)
+        thread.start()
+
+    def stop_recording(self, splitter_port=1):
+        thread, stop = self._recordings.pop(splitter_port)
+        stop.set()
+        thread.join()
+
+    def close(self):
+        for splitter_port in list(self._recordings):
+            self.stop_recording(splitter_port)
+
+    def _replay(self, output, encoded, stop):
+        period = 1 / self.framerate
+        next_time = time.monotonic()
+        i = 0
+        while not stop.is_set() and (self.loop or i < len(encoded)):
+            output.write(encoded[i % len(encoded)])
+            i += 1
+            next_time += period
+            time.sleep(max(0.0, next_time - time.monotonic()))
+        # Like picamera, flush the output when the recording stops
+        if hasattr(output, 'flush'):
+            output.flush()
+
+
+###############
+## EDGE TPU
+###############
+
+class StandInInterpreter(object):
+    """CPU stand-in for a tflite interpreter, with the methods that pycoral.adapters.common uses.
+
+    invoke() computes the output with output_fn from the input tensor and then waits until latency seconds have passed,
+    to emulate the time the Edge TPU needs (waiting releases the CPU, just like waiting for the accelerator).
+    """
+
+    def __init__(self, input_shape, output_fn, latency=0.0):
+        self._input = np.zeros(input_shape, dtype=np.uint8)
+        self._output = None
+        self.output_fn = output_fn
+        self.latency = latency
+        self.invokes = 0
+
+    def allocate_tensors(self):
+        pass
+
+    def get_input_details(self):
+        return [{'index': 0, 'shape': np.array(self._input.shape), 'dtype': np.uint8}]
+
+    def get_output_details(self):
+        return [{'index': 1}]
+
+    def tensor(self, index):
+        return lambda: self._input if index == 0 else self._output
+
+    def invoke(self):
+        start = time.perf_counter()
+        self._output = self.output_fn(self._input)
+        self.invokes += 1
+        remaining = self.latency - (time.perf_counter() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+def face_interpreter(latency=0.002, input_size=(128, 128)):
+    """Stand-in of the face recognition model: 'recognises' every face that is bright enough."""
+    return StandInInterpreter((1, input_size[1], input_size[0], 3),
+                              lambda x: np.array([[float(x.mean() > 100)]], dtype=np.float32),
+                              latency)
+
+
+def pose_interpreter(latency=0.013, input_size=(256, 256)):
+    """Stand-in of MoveNet: always returns the pose in pose.csv, in the (1, 1, 17, 3) output layout of MoveNet."""
+    pose = np.loadtxt(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pose.csv'), dtype=np.float32)
+    return StandInInterpreter((1, input_size[1], input_size[0], 3),
+                              lambda x: pose.reshape(1, 1, -1, 3).copy(),
+                              latency)
+
+
+# Copies of the helpers in pycoral.adapters.common
+def input_size(interpreter):
+    _, height, width, _ = interpreter.get_input_details()[0]['shape']
+    return int(width), int(height)
+
+
+def input_tensor(interpreter):
+    tensor_index = interpreter.get_input_details()[0]['index']
+    return interpreter.tensor(tensor_index)()[0]
+
+
+def set_input(interpreter, data):
+    input_tensor(interpreter)[:, :] = data
+
+
+def output_tensor(interpreter, i):
+    return interpreter.tensor(interpreter.get_output_details()[i]['index'])()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Check of the conversion of the camera's frame timestamps in latency.camera_clock, with a fake camera.
+
+    python -m pytest test_latency.py
+"""
+
+import time
+
+import latency
+
+
+class _Frame(object):
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+
+class _Encoder(object):
+    def __init__(self, timestamp):
+        self.frame = _Frame(timestamp)
+
+
+class FakeCamera(object):
+    """Camera with a GPU clock (in us) and one encoder per splitter port, like picamera with clock_mode='raw'."""
+
+    def __init__(self, now_us, frame_timestamps):
+        self.timestamp = now_us
+        self._encoders = {port: _Encoder(timestamp) for port, timestamp in frame_timestamps.items()}
+
+    @property
+    def frame(self):
+        # picamera returns the frame of whichever encoder comes first
+        return next(iter(self._encoders.values())).frame
+
+
+def test_age_of_the_frame():
+    camera = FakeCamera(5000000000, {1: 5000000000 - 40000})
+    before = time.monotonic()
+    capture = latency.camera_clock(camera)()
+    assert before - 0.041 <= capture <= time.monotonic() - 0.039
+
+
+def test_frame_of_the_own_splitter_port():
+    # The H.264 encoder on port 3 comes first, but the analysis output on port 2 must get its own frame's age
+    camera = FakeCamera(5000000000, {3: 5000000000 - 5000, 1: 5000000000 - 20000, 2: 5000000000 - 100000})
+    now = time.monotonic()
+    assert abs(now - latency.camera_clock(camera, splitter_port=2)() - 0.1) < 0.005
+    assert abs(now - latency.camera_clock(camera, splitter_port=1)() - 0.02) < 0.005
+
+
+def test_without_frame_information():
+    camera = FakeCamera(5000000000, {1: None})
+    before = time.monotonic()
+    assert before <= latency.camera_clock(camera)() <= time.monotonic()
+    assert before <= latency.camera_clock(camera, splitter_port=2)() <= time.monotonic()
+
+
+def test_splitter_port_without_encoder(caplog):
+    # Before the recording on the port starts, or with a picamera without per-port encoders
+    camera = FakeCamera(5000000000, {1: 5000000000 - 40000})
+    clock = latency.camera_clock(camera, splitter_port=2)
+    before = time.monotonic()
+    assert before <= clock() <= time.monotonic()
+    assert before <= clock() <= time.monotonic()
+    del camera._encoders
+    assert before <= clock() <= time.monotonic()
+    assert len(caplog.records) == 1
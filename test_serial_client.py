@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Check of the parsing of the Arduino's answers in serial_client.SerialClient, with a fake serial port.
+
+    python -m pytest test_serial_client.py
+"""
+
+import time
+
+import serial
+
+import serial_client
+
+
+class FakeSerial(object):
+    """Serial port that records the written bytes and never receives anything, the tests feed the answers directly."""
+
+    def __init__(self, *args, **kwargs):
+        self.written = []
+        self.in_waiting = 0
+
+    def write(self, data):
+        self.written.append(data)
+
+    def read(self, size=1):
+        time.sleep(0.01)
+        return b''
+
+    def close(self):
+        pass
+
+
+def ack(seq):
+    return bytes([serial_client.ACK_START, seq, serial_client.checksum([seq])])
+
+
+def test_corrupt_ack_followed_by_valid_acks(monkeypatch):
+    monkeypatch.setattr(serial, 'Serial', FakeSerial)
+    with serial_client.SerialClient(protocol='binary', settle=0, max_in_flight=4, ack_timeout=60) as client:
+        for i in range(3):
+            client.drive(100 + i, 100)
+        corrupt = bytes([serial_client.ACK_START, 1, serial_client.checksum([1]) ^ 0x5A])
+        rest = client._parse(corrupt + ack(2) + ack(3), time.monotonic())
+
+        assert rest == b''
+        stats = client.latency()
+        assert stats['corrupt'] == 1
+        assert stats['n'] == 2  # Packets 2 and 3 are acknowledged, packet 1 counts as lost
+        assert stats['lost'] == 1
+        assert stats['in_flight'] == 0
+
+
+def test_corrupt_ack_split_over_reads(monkeypatch):
+    monkeypatch.setattr(serial, 'Serial', FakeSerial)
+    with serial_client.SerialClient(protocol='binary', settle=0, max_in_flight=4, ack_timeout=60) as client:
+        for i in range(2):
+            client.drive(100 + i, 100)
+        corrupt = bytes([serial_client.ACK_START, 0x0A, 0x00])  # The wrong checksum is followed by a newline byte
+        rest = client._parse(corrupt, time.monotonic())
+        rest = client._parse(rest + ack(2), time.monotonic())
+
+        assert rest == b''
+        assert client.latency()['n'] == 1
+        assert client.latency()['in_flight'] == 0
+
+
+def test_text_echo(monkeypatch):
+    monkeypatch.setattr(serial, 'Serial', FakeSerial)
+    with serial_client.SerialClient(protocol='text', settle=0) as client:
+        client.send('w', 0)
+        rest = client._parse(b'w\r\n', time.monotonic())
+        rest = client._parse(rest + b'0\r\n', time.monotonic())
+
+        assert rest == b''
+        assert client.latency()['n'] == 1
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Face tracking that avoids running the Haar cascade over the full frame on every frame.
+
+The full cascade only runs every few frames (or as soon as a face got lost). In between, every known face is only
+searched for in a padded region of interest around its last position, at scales close to its last size. Each face
+keeps a persistent track ID, so results (e.g. the face recognition) can be cached per person.
+"""
+
+import itertools
+import time
+
+import numpy as np
+import cv2
+
+import vision
+
+
+class Track(object):
+    """A face that is followed over several frames."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, rect):
+        self.id = next(Track._ids)
+        self.rect = rect  # (x, y, w, h) of the last known position
+        self.misses = 0  # Number of consecutive frames in which the face was not found
+
+
+def iou(a, b):
+    """Intersection over union of two (x, y, w, h) rectangles."""
+    x1 = max(a[0], b[0])
+    y1 = max(a[1], b[1])
+    x2 = min(a[0] + a[2], b[0] + b[2])
+    y2 = min(a[1] + a[3], b[1] + b[3])
+    inter = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+class FaceTracker(object):
+    """Hybrid of full-frame face detection every detect_interval frames and cheap ROI searches in between."""
+
+    def __init__(self, det, detect_interval=5, min_size=(152, 152), padding=0.3, scale_range=1.25, max_misses=3,
+                 min_iou=0.3):
+        self.det = det  # Haar cascade classifier
+        self.min_size = min_size  # Minimum size of a face in the full-frame detection
+        self.detect_interval = detect_interval  # Run the full cascade every n frames (1 -> every frame)
+        self.padding = padding  # Padding around the last box that is searched, relative to the box size
+        self.scale_range = scale_range  # Allowed change of the face size between two frames
+        self.max_misses = max_misses  # Drop a track after it was not found this many times in a row
+        self.min_iou = min_iou  # Minimum overlap to match a full-frame detection to an existing track
+
+        self.tracks = []
+        self.frame_i = 0
+        self.force_detect = True  # Run the full cascade on the next frame, e.g. after a face was lost
+
+    def update(self, gray):
+        """Finds the faces in the next greyscale frame and returns the tracks that are visible in it."""
+        if self.force_detect or self.frame_i % self.detect_interval == 0:
+            self._detect(gray)
+        else:
+            self._track(gray)
+        self.frame_i += 1
+        return [track for track in self.tracks if track.misses == 0]
+
+    def live_ids(self):
+        """IDs of all tracks that are not lost yet, including faces that were just missed on the last frames."""
+        return set(track.id for track in self.tracks)
+
+    def _detect(self, gray):
+        """Runs the cascade over the full frame and matches the detections to the existing tracks."""
+        rects = vision.detect_faces(self.det, gray, min_size=self.min_size)
+        self.force_detect = False
+
+        # Greedily match each detection to the unmatched track it overlaps the most with
+        unmatched = list(self.tracks)
+        for rect in rects:
+            best = max(unmatched, key=lambda t: iou(t.rect, rect), default=None)
+            if best is not None and iou(best.rect, rect) >= self.min_iou:
+                best.rect = rect
+                best.misses = 0
+                unmatched.remove(best)
+            else:
+                self.tracks.append(Track(rect))
+
+        # Tracks without detection are kept for a few frames, in case the cascade just missed them
+        for track in unmatched:
+            track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+    def _track(self, gray):
+        """Searches every tracked face only in a padded region around its last position."""
+        height, width = gray.shape[:2]
+        for track in self.tracks:
+            x, y, w, h = track.rect
+            pad_x, pad_y = int(w * self.padding), int(h * self.padding)
+            x0, y0 = max(0, x - pad_x), max(0, y - pad_y)
+            x1, y1 = min(width, x + w + pad_x), min(height, y + h + pad_y)
+
+            # Only look for faces of roughly the same size as before
+            min_size = (int(w / self.scale_range), int(h / self.scale_range))
+            max_size = (int(w * self.scale_range), int(h * self.scale_range))
+            rects = vision.detect_faces(self.det, gray[y0:y1, x0:x1], min_size=min_size, max_size=max_size)
+
+            if len(rects) > 0:
+                # Shift the best match from ROI back to frame coordinates
+                rects = [(rx + x0, ry + y0, rw, rh) for (rx, ry, rw, rh) in rects]
+                track.rect = max(rects, key=lambda r: iou(track.rect, r))
+                track.misses = 0
+            else:
+                # Confidence dropped, search the full frame again on the next frame
+                track.misses += 1
+                self.force_detect = True
+
+
+class RecognitionCache(object):
+    """Caches the face recognition result of every track, so the Edge TPU only runs a few times per second per person.
+
+    A cached result is re-computed when it is older than refresh_interval seconds, or when the face crop changed a lot
+    (mean absolute difference of a small thumbnail above change_threshold grey values). It is dropped as soon as the
+    tracker drops its track (live_ids), not when the face is only missed on a few frames.
+    """
+
+    def __init__(self, refresh_interval=0.5, change_threshold=25, thumb_size=(16, 16)):
+        self.refresh_interval = refresh_interval
+        self.change_threshold = change_threshold
+        self.thumb_size = thumb_size
+        self.entries = {}  # Track ID -> (recognized, time of the recognition, thumbnail of the recognised crop)
+        self.invokes = 0  # Number of times the recognition model actually ran
+
+    def submit(self, service, frame, tracks, live_ids=None):
+        """Sends the faces of the (track ID, rect) pairs whose cached result is outdated to the face model of an
+        inference.InferenceService. Returns a function that waits for their results and then returns the rectangle
+        color of every track."""
+        now = time.monotonic()
+        requests = []
+        for track_id, rect in tracks:
+            face = vision.crop_face(frame, rect)
+            thumb = self._thumbnail(face)
+            if self._outdated(self.entries.get(track_id), thumb, now):
+                requests.append((track_id, service.submit('face', face), thumb))
+
+        def colors():
+            for track_id, future, thumb in requests:
+                self.entries[track_id] = (vision.face_recognised(future.result()), now, thumb)
+                self.invokes += 1
+            return self.cached(tracks, live_ids)
+        return colors
+
+    def cached(self, tracks, live_ids=None):
+        """Returns the colors of the last recognition of every track without running the model, for frames on which
+        the recognition is skipped. Faces that were never recognised count as unknown. live_ids are the tracks that
+        the tracker still follows (None -> only the given tracks)."""
+        colors = [vision.face_color(self.entries[track_id][0] if track_id in self.entries else False)
+                  for track_id, _ in tracks]
+        self._prune(tracks, live_ids)
+        return colors
+
+    def _thumbnail(self, face):
+        return cv2.resize(face, self.thumb_size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def _outdated(self, entry, thumb, now):
+        """Whether the cached result of a face has to be computed again."""
+        return entry is None or now - entry[1] > self.refresh_interval or \
+            np.mean(np.abs(thumb - entry[2])) > self.change_threshold
+
+    def _prune(self, tracks, live_ids):
+        # Forget the results of all tracks that were lost. A face that is only missed on this frame keeps its result.
+        active = set(track_id for track_id, _ in tracks)
+        if live_ids is not None:
+            active |= set(live_ids)
+        for track_id in list(self.entries):
+            if track_id not in active:
+                del self.entries[track_id]
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Image processing stages of the camera stream (face detection/recognition, pose detection; drawing is in overlay.py).
+The functions hold no state and open no hardware, so they can run in any thread or worker process.
+"""
+
+import numpy as np
+import cv2
+
+# Set constants
+BORDER = 8  # Border size [px] of detected faces on stream
+_NUM_KEYPOINTS = 17  # Number of detection points for pose detection
+common = None  # Helpers of pycoral.adapters.common, see model_helpers()
+
+# Dictionary to map key points to joints of body parts
+KEYPOINT_DICT = {
+    'nose': 0,
+    'left_eye': 1,
+    'right_eye': 2,
+    'left_ear': 3,
+    'right_ear': 4,
+    'left_shoulder': 5,
+    'right_shoulder': 6,
+    'left_elbow': 7,
+    'right_elbow': 8,
+    'left_wrist': 9,
+    'right_wrist': 10,
+    'left_hip': 11,
+    'right_hip': 12,
+    'left_knee': 13,
+    'right_knee': 14,
+    'left_ankle': 15,
+    'right_ankle': 16
+}
+
+# Map bones (connection between certain key points) to colors
+KEYPOINT_EDGE_INDS_TO_COLOR = {
+    # Lines between nose, eyes and ears
+    (0, 1): (255, 0, 0),
+    (0, 2): (255, 0, 0),
+    (1, 3): (255, 0, 0),
+    (2, 4): (255, 0, 0),
+
+    # Lines of arms
+    (5, 7): (0, 255, 0),
+    (7, 9): (0, 255, 0),
+    (6, 8): (0, 255, 0),
+    (8, 10): (0, 255, 0),
+
+    # Lines of torso
+    (5, 6): (0, 0, 255),
+    (5, 11): (0, 0, 255),
+    (6, 12): (0, 0, 255),
+    (11, 12): (0, 0, 255),
+
+    # Lines of legs
+    (11, 13): (255, 255, 255),
+    (13, 15): (255, 255, 255),
+    (12, 14): (255, 255, 255),
+    (14, 16): (255, 255, 255)
+}
+
+
+def decode_frame(buf):
+    """Decodes a JPEG frame (bytes) into a BGR numpy array."""
+    return cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def encode_frame(frame):
+    """Encodes a BGR numpy array into a JPEG frame that can be streamed."""
+    _, jpeg = cv2.imencode('.JPEG', frame)
+    return jpeg
+
+
+def detect_faces(det, gray, min_size=(152, 152), max_size=(0, 0)):
+    """Finds all faces in a greyscale frame with the Haar cascade classifier det. max_size (0, 0) means no limit."""
+
+    # Output rects will be a list of tuples with x/y coordinates of the top-left corner of the
+    # detected face rectangle and the width and height of the rectangle
+    rects = det.detectMultiScale(gray,
+                                 scaleFactor=1.1,
+                                 # How much the image should be scaled down per processing layer
+                                 minNeighbors=6,
+                                 # Detection threshold (higher -> more certain faces are detected)
+                                 minSize=min_size,
+                                 # Minimum size of a detected face, depends on face-camera distance
+                                 maxSize=max_size,
+                                 flags=cv2.CASCADE_SCALE_IMAGE)
+    return [tuple(int(v) for v in rect) for rect in rects]
+
+
+def frame_scale(frame_shape, analysis_shape):
+    """(x, y) factors between the analysed and the streamed frame, which can have different aspect ratios."""
+    return frame_shape[1] / analysis_shape[1], frame_shape[0] / analysis_shape[0]
+
+
+def scale_rects(rects, scale):
+    """Maps (x, y, w, h) rectangles from the analysed frame to a frame that is larger by the (x, y) factors of
+    scale."""
+    sx, sy = scale
+    if sx == 1 and sy == 1:
+        return list(rects)
+    return [(int(round(x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy))) for x, y, w, h in rects]
+
+
+def crop_face(frame, rect):
+    """Crops out a detected face from the frame, without the border of the drawn rectangle."""
+    x, y, w, h = rect
+    return frame[y + BORDER:y + h - BORDER, x + BORDER:x + w - BORDER]
+
+
+def use_helpers(helpers):
+    """Replaces pycoral.adapters.common for the models, e.g. by stand_ins for the CPU stand-in interpreters."""
+    global common
+    common = helpers
+
+
+def model_helpers():
+    """The input_size/set_input/output_tensor helpers of the interpreters, pycoral.adapters.common unless
+    use_helpers() replaced them."""
+    global common
+    if common is None:
+        # Imported here, so the scripts without models also run without pycoral
+        from pycoral.adapters import common as pycoral_common
+        common = pycoral_common
+    return common
+
+
+def recognise_face(interpreter, face):
+    """Runs the face recognition model on one face crop and returns if it is the trained person."""
+
+    common = model_helpers()
+    # This resizes the RGB image
+    resized_face = cv2.resize(face, common.input_size(interpreter))
+    # Send resized image to Coral
+    common.set_input(interpreter, resized_face)
+
+    # Do the job
+    interpreter.invoke()
+
+    # Get result if face is recognised or not
+    return face_recognised(common.output_tensor(interpreter, 0))
+
+
+def face_recognised(output):
+    """Whether the output of the face recognition model says that it is the trained person."""
+    return bool(output)
+
+
+def face_color(recognized):
+    """Color of the rectangle of a face: green if it is the trained person, otherwise blue."""
+    if recognized:
+        return (0, 255, 0)
+    else:
+        return (255, 0, 0)
+
+
+def recognise_faces(interpreter, frame, rects):
+    """Checks for every detected face if it is from the trained person, and returns the color to draw it with."""
+    return [face_color(recognise_face(interpreter, crop_face(frame, rect))) for rect in rects]
+
+
+def detect_pose(interpreter, frame):
+    """Runs the MoveNet pose detector on a frame and returns the (y, x, score) of every keypoint."""
+
+    common = model_helpers()
+    # This resizes the RGB image
+    resized_img = cv2.resize(frame, common.input_size(interpreter))
+    # Send resized image to Coral
+    common.set_input(interpreter, resized_img)
+
+    # Do the job
+    interpreter.invoke()
+
+    # Get the pose
+    return pose_keypoints(common.output_tensor(interpreter, 0).copy())
+
+
+def pose_keypoints(output):
+    """The (y, x, score) of every keypoint from the output of MoveNet."""
+    return output.reshape(_NUM_KEYPOINTS, 3)